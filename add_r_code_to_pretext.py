@@ -4,44 +4,28 @@ Script to extract R code chunks from Rmd files and add them to PreTeXt files.
 This adds <program language="r"> blocks to PreTeXt files where appropriate.
 """
 
+import argparse
+import os
 import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Optional
 import xml.etree.ElementTree as ET
 
+import numpy as np
 
-def extract_r_code_chunks(rmd_file: Path) -> List[Tuple[str, str, int]]:
+from rmd_chunks import ChunkTable, LineIndex, displayable_chunks
+
+
+def extract_r_code_chunks(rmd_file: Path, table: Optional[ChunkTable] = None) -> List[Tuple[str, str, int]]:
     """
-    Extract R code chunks from an Rmd file.
+    Extract the displayable R code chunks of an Rmd file, selected from a
+    chunk table (a temporary one if none is given).
     Returns list of tuples: (chunk_name, chunk_code, line_number)
     """
-    chunks = []
-    
-    with open(rmd_file, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
-    # Pattern to match R code chunks: ```{r ...} ... ```
-    # Captures the chunk header and the code
-    pattern = r'```\{r\s+([^}]*)\}(.*?)```'
-    
-    for match in re.finditer(pattern, content, re.DOTALL):
-        chunk_header = match.group(1).strip()
-        chunk_code = match.group(2).strip()
-        
-        # Extract chunk name (first word in header)
-        chunk_name = chunk_header.split(',')[0].strip() if chunk_header else 'unnamed'
-        
-        # Skip empty chunks
-        if not chunk_code:
-            continue
-            
-        # Find line number
-        line_num = content[:match.start()].count('\n') + 1
-        
-        chunks.append((chunk_name, chunk_code, line_num))
-    
-    return chunks
+    # Chunk name is the knitr label, or 'unnamed'
+    return [(chunk.name, chunk.code, chunk.line_num) for chunk in displayable_chunks(rmd_file, table)]
 
 
 def format_r_code_for_pretext(code: str, indent: int = 6) -> str:
@@ -52,34 +36,124 @@ def format_r_code_for_pretext(code: str, indent: int = 6) -> str:
     base_indent = ' ' * indent
     inner_indent = ' ' * (indent + 2)
     
-    result = f'{base_indent}<program language="r">\n'
-    result += f'{inner_indent}<input>\n'
+    parts = [f'{base_indent}<program language="r">', f'{inner_indent}<input>']
     
     # Add code lines with proper indentation
     for line in code.split('\n'):
-        result += f'{inner_indent}{line}\n'
+        parts.append(f'{inner_indent}{line}')
     
-    result += f'{inner_indent}</input>\n'
-    result += f'{base_indent}</program>\n'
+    parts.append(f'{inner_indent}</input>')
+    parts.append(f'{base_indent}</program>')
     
-    return result
+    return '\n'.join(parts) + '\n'
+
+
+PARAGRAPH = re.compile(r'<p\b[^>]*>(.*?)</p>', re.DOTALL)
+MARKUP = re.compile(r'<[^>]+>|&[a-z]+;|\\@ref\([^)]*\)|\$[^$]*\$')
+WORD = re.compile(r'[a-z][a-z0-9]+')
+STOP_WORDS = frozenset('''
+    the and that this with for are was were from have has had not but can will
+    which what when where who how than then there their these those they them
+    its into also such our your you one two more most some any all each other
+    been being use used using here just only very would could should may might
+    '''.split())
+
 
+def tokenize(text: str) -> List[str]:
+    """Lowercase content words of a piece of prose, with markup removed."""
+    words = WORD.findall(MARKUP.sub(' ', text).lower())
+    return [word for word in words if len(word) > 2 and word not in STOP_WORDS]
 
-def find_insertion_points(ptx_file: Path, rmd_file: Path) -> Dict[str, List[int]]:
+
+def tfidf_matrix(documents: List[List[str]], vocabulary: Dict[str, int],
+                 idf: 'np.ndarray') -> 'np.ndarray':
+    """
+    Term counts of tokenized documents as a (documents x vocabulary) matrix,
+    weighted by idf and L2-normalized per row. Unknown words are ignored.
+    """
+    rows = []
+    cols = []
+    for row, words in enumerate(documents):
+        ids = [vocabulary[word] for word in words if word in vocabulary]
+        rows.extend([row] * len(ids))
+        cols.extend(ids)
+    
+    matrix = np.zeros((len(documents), len(vocabulary)), dtype=np.float32)
+    np.add.at(matrix, (np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)), 1.0)
+    matrix *= idf
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+def find_insertion_points(ptx_file: Path, rmd_file: Path, min_score: float = 0.15,
+                          table: Optional[ChunkTable] = None) -> Dict[str, List[int]]:
     """
     Find appropriate insertion points in PreTeXt file for R code chunks.
-    This is a heuristic approach based on context matching.
+    
+    Every <p> of the PreTeXt file is TF-IDF vectorized once, the prose around
+    each Rmd chunk is vectorized with the same vocabulary, and all chunks are
+    scored against all paragraphs with a single matrix product. Each chunk is
+    placed after the paragraph whose wording is most similar to its context.
+    
+    Args:
+        ptx_file: Path to PreTeXt file
+        rmd_file: Path to Rmd file
+        min_score: Cosine similarity below which a chunk is left unplaced
+        table: Chunk table to select the displayable chunks from
+        
+    Returns:
+        Dict mapping chunk name to the line numbers (0-based list index of the
+        line to insert before, i.e. just after the matching </p>) for each
+        chunk with that name, in document order
     """
     insertion_points = {}
     
     with open(ptx_file, 'r', encoding='utf-8') as f:
-        ptx_lines = f.readlines()
+        ptx_content = f.read()
+    
+    # Lines end at '\n' only, as in the line lists the insertion points index
+    line_index = LineIndex()
+    for line in ptx_content.split('\n'):
+        line_index.append(len(line) + 1)
+    
+    paragraphs = []
+    paragraph_ends = []
+    for match in PARAGRAPH.finditer(ptx_content):
+        paragraphs.append(tokenize(match.group(1)))
+        paragraph_ends.append(line_index.line_of(match.end() - 1))
+    
+    chunks = displayable_chunks(rmd_file, table, context_before=1000, context_after=500)
+    if not paragraphs or not chunks:
+        return insertion_points
+    
+    # Vocabulary and inverse document frequencies come from the target paragraphs
+    vocabulary = {}
+    document_freq = []
+    for words in paragraphs:
+        for word in set(words):
+            if word not in vocabulary:
+                vocabulary[word] = len(vocabulary)
+                document_freq.append(0)
+            document_freq[vocabulary[word]] += 1
+    if not vocabulary:
+        return insertion_points
+    idf = (np.log((1 + len(paragraphs)) / (1 + np.array(document_freq, dtype=np.float32))) + 1)
+    
+    paragraph_matrix = tfidf_matrix(paragraphs, vocabulary, idf)
+    contexts = [tokenize(chunk.context_before + ' ' + chunk.context_after) for chunk in chunks]
+    context_matrix = tfidf_matrix(contexts, vocabulary, idf)
     
-    with open(rmd_file, 'r', encoding='utf-8') as f:
-        rmd_content = f.read()
+    # One batched product scores every chunk against every paragraph
+    scores = context_matrix @ paragraph_matrix.T
+    best = scores.argmax(axis=1)
+    best_scores = scores[np.arange(len(chunks)), best]
+    
+    for chunk, paragraph, score in zip(chunks, best, best_scores):
+        if score < min_score:
+            continue
+        insertion_points.setdefault(chunk.name, []).append(paragraph_ends[paragraph])
     
-    # For now, return empty dict - we'll manually identify sections
-    # In a production system, this would use more sophisticated matching
     return insertion_points
 
 
@@ -107,46 +181,91 @@ def add_r_code_to_section(ptx_content: str, chunk_name: str, r_code: str,
     return result
 
 
-def main():
+# Map of Rmd files to PreTeXt files
+FILE_MAPPING = {
+    '09-HypothesisTesting.Rmd': 'source/ch-hypothesis-testing.ptx',
+    '10-ConfIntEffectSize.Rmd': 'source/ch-quantifying-effects.ptx',
+    '11-BayesianStatistics.Rmd': 'source/ch-bayesian-statistics.ptx',
+    '12-CategoricalRelationships.Rmd': 'source/ch-categorical-relationships.ptx',
+    '13-ContinuousRelationships.Rmd': 'source/ch-continuous-relationships.ptx',
+    '14-GeneralLinearModel.Rmd': 'source/ch-general-linear-model.ptx',
+    '15-ComparingMeans.Rmd': 'source/ch-comparing-means.ptx',
+    '16-MultivariateStats.Rmd': 'source/ch-multivariate-statistics.ptx',
+    '17-PracticalExamples.Rmd': 'source/ch-practical-examples.ptx',
+}
+
+BASE_DIR = Path('/home/runner/work/statsthinking21-core/statsthinking21-core')
+
+
+def process_file_pair(task: Tuple[Path, str, str, Optional[ChunkTable]]) -> Dict:
+    """
+    Extract the R chunks for one Rmd -> PreTeXt pair. Runs in a worker process
+    when --jobs > 1, so it returns its report lines instead of printing them.
+    
+    Args:
+        task: Tuple (base_dir, rmd_name, ptx_name, table), where table is the
+            chunk table of the run (or None)
+    """
+    base_dir, rmd_name, ptx_name, table = task
+    rmd_file = base_dir / rmd_name
+    ptx_file = base_dir / ptx_name
+    result = {'rmd': rmd_name, 'ptx': ptx_name, 'chunks': [], 'insertion_points': {}, 'lines': []}
+    
+    if not rmd_file.exists():
+        result['lines'].append(f"Warning: {rmd_file} not found")
+        return result
+    
+    if not ptx_file.exists():
+        result['lines'].append(f"Warning: {ptx_file} not found")
+        return result
+    
+    result['lines'].append(f"\nProcessing {rmd_name} -> {ptx_name}")
+    
+    # Extract R code chunks
+    chunks = extract_r_code_chunks(rmd_file, table)
+    result['chunks'] = chunks
+    result['lines'].append(f"Found {len(chunks)} R code chunks")
+    
+    # Display chunks for review
+    for name, code, line_num in chunks[:5]:  # Show first 5
+        result['lines'].append(f"  - Chunk '{name}' at line {line_num} ({len(code)} chars)")
+    
+    # Suggest placements from context similarity
+    result['insertion_points'] = find_insertion_points(ptx_file, rmd_file, table=table)
+    placed = sum(len(lines) for lines in result['insertion_points'].values())
+    result['lines'].append(f"Context matching placed {placed} of {len(chunks)} chunks")
+    
+    return result
+
+
+def main(argv: Optional[List[str]] = None):
     """Main function to process files."""
     
-    # Map of Rmd files to PreTeXt files
-    file_mapping = {
-        '09-HypothesisTesting.Rmd': 'source/ch-hypothesis-testing.ptx',
-        '10-ConfIntEffectSize.Rmd': 'source/ch-quantifying-effects.ptx',
-        '11-BayesianStatistics.Rmd': 'source/ch-bayesian-statistics.ptx',
-        '12-CategoricalRelationships.Rmd': 'source/ch-categorical-relationships.ptx',
-        '13-ContinuousRelationships.Rmd': 'source/ch-continuous-relationships.ptx',
-        '14-GeneralLinearModel.Rmd': 'source/ch-general-linear-model.ptx',
-        '15-ComparingMeans.Rmd': 'source/ch-comparing-means.ptx',
-        '16-MultivariateStats.Rmd': 'source/ch-multivariate-statistics.ptx',
-        '17-PracticalExamples.Rmd': 'source/ch-practical-examples.ptx',
-    }
-    
-    base_dir = Path('/home/runner/work/statsthinking21-core/statsthinking21-core')
-    
-    # Process each file
-    for rmd_name, ptx_name in file_mapping.items():
-        rmd_file = base_dir / rmd_name
-        ptx_file = base_dir / ptx_name
-        
-        if not rmd_file.exists():
-            print(f"Warning: {rmd_file} not found")
-            continue
-        
-        if not ptx_file.exists():
-            print(f"Warning: {ptx_file} not found")
-            continue
-        
-        print(f"\nProcessing {rmd_name} -> {ptx_name}")
-        
-        # Extract R code chunks
-        chunks = extract_r_code_chunks(rmd_file)
-        print(f"Found {len(chunks)} R code chunks")
-        
-        # Display chunks for review
-        for name, code, line_num in chunks[:5]:  # Show first 5
-            print(f"  - Chunk '{name}' at line {line_num} ({len(code)} chars)")
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--base-dir', type=Path, default=BASE_DIR,
+                        help='repository root containing the Rmd and source/ files')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of file pairs to process in parallel (0 = one per CPU core)')
+    parser.add_argument('--chunk-table', type=Path, default=None, metavar='NPZ',
+                        help='reuse and update this saved chunk table (e.g. the one insert_r_code.py keeps)')
+    args = parser.parse_args(argv)
+    jobs = args.jobs or os.cpu_count() or 1
+    
+    # Tokenize every Rmd file once; each pair selects its chunks from the table
+    rmd_files = [args.base_dir / rmd_name for rmd_name in FILE_MAPPING if (args.base_dir / rmd_name).exists()]
+    table = ChunkTable.cached(args.chunk_table, rmd_files)
+    
+    tasks = [(args.base_dir, rmd_name, ptx_name, table) for rmd_name, ptx_name in FILE_MAPPING.items()]
+    
+    # Process each file; results come back in mapping order either way
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = pool.map(process_file_pair, tasks)
+            for result in results:
+                print('\n'.join(result['lines']))
+    else:
+        for task in tasks:
+            print('\n'.join(process_file_pair(task)['lines']))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Benchmark the Rmd -> PreTeXt conversion pipeline on synthetic chapters.
+
+Generates Rmd/.ptx pairs at multiples of the size of a real chapter (about
+20 R chunks and 70 paragraphs, like 14-GeneralLinearModel.Rmd and
+ch-general-linear-model.ptx) and times each stage of insert_r_code.py:
+
+- extract: extract_r_code_chunks on the Rmd
+- format: format_r_code_for_pretext for every displayable chunk
+- find_section: find_section_for_insertion, once per query (legacy per-block scan)
+- anchor_index: building an AnchorIndex and answering every query from it
+- insert: insert_code_blocks_in_chapter, including the write
+
+For each stage it reports wall time, throughput and (in a second,
+traced run) peak Python memory. Use --json to keep the numbers for comparison
+across changes.
+
+Usage:
+    python3 benchmark_conversion.py --scales 1,10,100
+    python3 benchmark_conversion.py --chunk-lines 40 --anchor-density 0.2 --json bench.json
+"""
+
+import argparse
+import io
+import json
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+from insert_r_code import (AnchorIndex, extract_r_code_chunks, find_section_for_insertion,
+                           format_r_code_for_pretext, insert_code_blocks_in_chapter)
+
+
+# Size of a real chapter at scale 1
+BASE_CHUNKS = 20
+BASE_PARAGRAPHS = 70
+
+PROSE = ('The general linear model describes the relation between a set of predictors and '
+         'an outcome, and the residuals tell us how far each observation is from the fit. ')
+
+
+def generate_rmd(path: Path, n_chunks: int, chunk_lines: int, hidden_every: int = 4):
+    """Write a synthetic Rmd file with n_chunks R chunks separated by prose."""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('# Synthetic chapter\n\n')
+        for i in range(n_chunks):
+            f.write(f'## Section {i}\n\n{PROSE * 3}\n\n')
+            options = ', echo=FALSE, fig.width=4' if hidden_every and i % hidden_every == 0 else ''
+            f.write(f'```{{r chunk_{i}{options}}}\n')
+            for j in range(chunk_lines):
+                f.write(f'x_{i}_{j} <- c({j}, {j + 1}) & y > {j}  # step {j}\n')
+            f.write('```\n\n')
+
+
+def generate_ptx(path: Path, n_paragraphs: int, anchor_density: float, program_every: int = 10) -> List[str]:
+    """
+    Write a synthetic PreTeXt chapter. A fraction anchor_density of the
+    paragraphs carry a unique anchor phrase; every program_every-th
+    paragraph is followed by an existing R program block.
+
+    Returns:
+        The anchor phrases, in document order
+    """
+    anchors = []
+    step = max(1, round(1 / anchor_density)) if anchor_density > 0 else 0
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<chapter xml:id="ch-synthetic">\n')
+        f.write('  <title>Synthetic</title>\n  <section xml:id="sec-synthetic">\n')
+        for i in range(n_paragraphs):
+            text = PROSE * 2
+            if step and i % step == 0:
+                anchor = f'anchor phrase number {i}'
+                anchors.append(anchor)
+                text += anchor + '.'
+            f.write(f'    <p>\n      {text}\n    </p>\n')
+            if program_every and i % program_every == program_every - 1:
+                f.write(f'    <program language="r">\n      <input>\n      existing_{i} &lt;- {i}\n'
+                        f'      </input>\n    </program>\n')
+        f.write('  </section>\n</chapter>\n')
+    return anchors
+
+
+def measure(func: Callable, trace_memory: bool) -> Tuple[float, int]:
+    """Run func once; return (seconds, peak traced bytes or 0)."""
+    if trace_memory:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return 0.0, peak
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start, 0
+
+
+def run_scale(workdir: Path, scale: int, args: argparse.Namespace) -> List[Dict]:
+    """Generate one chapter pair at a scale and benchmark every stage on it."""
+    n_chunks = BASE_CHUNKS * scale
+    n_paragraphs = BASE_PARAGRAPHS * scale
+    rmd_file = workdir / f'synthetic-{scale}.Rmd'
+    ptx_template = workdir / f'synthetic-{scale}.ptx'
+    ptx_file = workdir / f'synthetic-{scale}-work.ptx'
+
+    generate_rmd(rmd_file, n_chunks, args.chunk_lines)
+    anchors = generate_ptx(ptx_template, n_paragraphs, args.anchor_density)
+    rmd_bytes = rmd_file.stat().st_size
+    ptx_bytes = ptx_template.stat().st_size
+    ptx_content = ptx_template.read_text(encoding='utf-8')
+    ptx_lines = ptx_content.split('\n')
+
+    chunks = extract_r_code_chunks(rmd_file)
+    codes = [chunk['code'] for chunk in chunks]
+    patterns = [anchors[i % len(anchors)] for i in range(len(codes))] if anchors else []
+    code_blocks = list(zip(patterns, codes, [2] * len(codes)))
+    queries = patterns[:args.max_queries]
+
+    def insert():
+        shutil.copyfile(ptx_template, ptx_file)
+        with redirect_stdout(io.StringIO()):
+            insert_code_blocks_in_chapter(ptx_file, code_blocks)
+
+    def anchor_index():
+        index = AnchorIndex(ptx_lines, patterns)
+        for pattern in patterns:
+            index.find(pattern)
+
+    stages = [
+        ('extract', lambda: extract_r_code_chunks(rmd_file), rmd_bytes, n_chunks),
+        ('format', lambda: [format_r_code_for_pretext(code) for code in codes], 0, len(codes)),
+        ('find_section', lambda: [find_section_for_insertion(ptx_content, q) for q in queries],
+         0, len(queries)),
+        ('anchor_index', anchor_index, ptx_bytes, len(patterns)),
+        ('insert', insert, ptx_bytes, len(code_blocks)),
+    ]
+
+    results = []
+    for name, func, size, items in stages:
+        if name not in args.stages:
+            continue
+        seconds = min(measure(func, False)[0] for _ in range(args.repeat))
+        peak = measure(func, True)[1] if args.memory else 0
+        results.append({
+            'scale': scale,
+            'stage': name,
+            'seconds': seconds,
+            'items': items,
+            'items_per_s': items / seconds if seconds else None,
+            'mb_per_s': size / seconds / 1e6 if size and seconds else None,
+            'peak_mb': peak / 1e6 if args.memory else None,
+            'rmd_bytes': rmd_bytes,
+            'ptx_bytes': ptx_bytes,
+        })
+    return results
+
+
+def print_results(results: List[Dict]):
+    """Print the benchmark results as a table."""
+    print(f"{'scale':>6} {'stage':<13} {'seconds':>10} {'items':>8} {'items/s':>12} {'MB/s':>9} {'peak MB':>9}")
+    for r in results:
+        items_per_s = f"{r['items_per_s']:.0f}" if r['items_per_s'] else '-'
+        mb_per_s = f"{r['mb_per_s']:.1f}" if r['mb_per_s'] else '-'
+        peak = f"{r['peak_mb']:.1f}" if r['peak_mb'] is not None else '-'
+        print(f"{r['scale']:>6} {r['stage']:<13} {r['seconds']:>10.4f} {r['items']:>8} "
+              f"{items_per_s:>12} {mb_per_s:>9} {peak:>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Rmd -> PreTeXt conversion stages.')
+    parser.add_argument('--scales', default='1,10,100,1000',
+                        help='comma-separated multiples of a real chapter (default: 1,10,100,1000)')
+    parser.add_argument('--chunk-lines', type=int, default=10, help='lines of code per chunk')
+    parser.add_argument('--anchor-density', type=float, default=0.5,
+                        help='fraction of paragraphs that carry an anchor phrase')
+    parser.add_argument('--max-queries', type=int, default=200,
+                        help='cap on find_section_for_insertion calls per scale (each one scans the file)')
+    parser.add_argument('--stages', default='extract,format,find_section,anchor_index,insert',
+                        help='comma-separated stages to run')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage (best is kept)')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the traced run that measures peak memory')
+    parser.add_argument('--json', type=Path, help='also write the results to this JSON file')
+    args = parser.parse_args(argv)
+    args.stages = set(args.stages.split(','))
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench-conversion-') as tmp:
+        for scale in [int(s) for s in args.scales.split(',')]:
+            results.extend(run_scale(Path(tmp), scale, args))
+            print_results([r for r in results if r['scale'] == scale])
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'settings': {'chunk_lines': args.chunk_lines,
+                                    'anchor_density': args.anchor_density,
+                                    'max_queries': args.max_queries},
+                       'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
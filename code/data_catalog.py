@@ -0,0 +1,231 @@
+"""
+Python counterpart of R/load_data.R: named loaders for the datasets in data/.
+
+Each dataset is parsed from its text file once, with explicit dtypes, and
+stored in a columnar cache under data/.cache keyed on the SHA-256 of the
+source file. Later loads read only the requested columns from the cache:
+
+    import data_catalog
+    stops = data_catalog.load('ct_stops')
+    fb = data_catalog.dataset('facebook')
+    degree = fb['V1'].value_counts()
+
+The cache is Parquet when pyarrow (in requirements.txt) is installed, and
+otherwise one pickle per column; both keep the dtypes and let a load skip
+unrequested columns. Editing a source file changes its hash, so the next
+load rebuilds that dataset.
+
+Usage:
+    python code/data_catalog.py              # list datasets and cache state
+    python code/data_catalog.py --build      # build every cache
+    python code/data_catalog.py --build ct_stops facebook
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import tempfile
+from pathlib import Path
+
+import pandas
+
+from file_utils import file_digest, write_json_atomic
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+DATA_DIR = Path(__file__).resolve().parent.parent / 'data'
+CACHE_DIR = DATA_DIR / '.cache'
+# name of a finished cache entry: the start of the source digest (see Dataset.cache_path)
+CACHE_NAME = re.compile(r'[0-9a-f]{16}(\.parquet)?')
+
+
+def parse_dollars(frame):
+    """
+    Convert columns of amounts such as "$1,074,949.50 " to floats; amounts
+    in parentheses, such as "($933.00)", are negative.
+    """
+    for column in frame.columns:
+        values = frame[column].dropna()
+        if pandas.api.types.is_string_dtype(values) and len(values) and values.str.match(r'\(?\$').all():
+            amounts = frame[column].str.replace(r'[$,\s)]', '', regex=True).str.replace('(', '-')
+            frame[column] = pandas.to_numeric(amounts)
+    return frame
+
+
+def recode_sex(frame):
+    """Recode Sex from 0/1 to Male/Female, as 16-MultivariateStats.Rmd does."""
+    frame['Sex'] = frame['Sex'].map({0: 'Male', 1: 'Female'}).astype('category')
+    return frame
+
+
+# name -> source file (relative to data/), pandas.read_csv arguments and an
+# optional function applied to the parsed frame before it is cached
+CATALOG = {
+    'ct_stops': {
+        'path': 'CT_data_cleaned.csv',
+        'read': {'dtype': {'driver_race': 'category', 'search_conducted': 'boolean'}},
+    },
+    'eisenberg_behavior': {
+        'path': 'Eisenberg/meaningful_variables.csv',
+        'read': {'dtype': {'subcode': str}},
+    },
+    'eisenberg_behavior_clean': {
+        'path': 'Eisenberg/meaningful_variables_clean.csv',
+        'prepare': lambda frame: frame.rename(columns={'Unnamed: 0': 'subcode'}),
+    },
+    'eisenberg_demographics': {
+        'path': 'Eisenberg/demographic_health.csv',
+        'read': {'dtype': {'subcode': str}},
+        'prepare': recode_sex,
+    },
+    'campaign_finance': {
+        'path': 'campaign_finance/CandidateSummaryAction1.csv',
+        'read': {'dtype': {'can_zip': str, 'can_off_dis': str}},
+        'prepare': parse_dollars,
+    },
+    'facebook': {
+        'path': '04/facebook_combined.txt',
+        # the column names read.table gives the edge list in 03-SummarizingData.Rmd
+        'read': {'sep': ' ', 'header': None, 'names': ['V1', 'V2'], 'dtype': 'int32'},
+    },
+}
+
+
+def source_digest(source):
+    """
+    SHA-256 of a source file. Digests are remembered in data/.cache/hashes.json
+    together with the file's size and mtime, so unchanged files are not reread.
+    """
+    hashes_file = CACHE_DIR / 'hashes.json'
+    try:
+        with open(hashes_file) as f:
+            hashes = json.load(f)
+    except (OSError, ValueError):
+        hashes = {}
+    st = source.stat()
+    key = str(source.relative_to(DATA_DIR))
+    if key in hashes and hashes[key][:2] == [st.st_size, st.st_mtime_ns]:
+        return hashes[key][2]
+
+    hashes[key] = [st.st_size, st.st_mtime_ns, file_digest(source)]
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    write_json_atomic(hashes_file, hashes, sort_keys=True)
+    return hashes[key][2]
+
+
+class Dataset:
+    """
+    One catalog entry. Nothing is read until columns or data are requested;
+    the cache is built on first use.
+    """
+
+    def __init__(self, name):
+        if name not in CATALOG:
+            raise KeyError(f'unknown dataset {name!r}; known: {", ".join(sorted(CATALOG))}')
+        self.name = name
+        self.spec = CATALOG[name]
+        self.source = DATA_DIR / self.spec['path']
+
+    def cache_path(self):
+        """Cache location for the current content of the source file."""
+        suffix = '.parquet' if pq is not None else ''
+        return CACHE_DIR / self.name / (source_digest(self.source)[:16] + suffix)
+
+    def is_cached(self):
+        return self.cache_path().exists()
+
+    def build(self):
+        """Parse the source file and write the cache, replacing older versions."""
+        path = self.cache_path()
+        if path.exists():
+            return path
+        frame = pandas.read_csv(self.source, **self.spec.get('read', {}))
+        if 'prepare' in self.spec:
+            frame = self.spec['prepare'](frame)
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=path.parent))
+        try:
+            if pq is not None:
+                frame.to_parquet(tmp / 'data.parquet', index=False)
+                os.replace(tmp / 'data.parquet', path)
+            else:
+                columns = [str(column) for column in frame.columns]
+                for i, column in enumerate(frame.columns):
+                    frame[column].to_pickle(tmp / f'{i}.pkl')
+                with open(tmp / 'columns.json', 'w') as f:
+                    json.dump(columns, f)
+                try:
+                    os.replace(tmp, path)
+                except OSError:
+                    # a concurrent build of the same data finished first
+                    if not path.is_dir():
+                        raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        # remove older versions; temporary directories of concurrent builds are left alone
+        for old in path.parent.iterdir():
+            if old == path or not CACHE_NAME.fullmatch(old.name):
+                continue
+            if old.is_dir():
+                shutil.rmtree(old, ignore_errors=True)
+            else:
+                old.unlink(missing_ok=True)
+        return path
+
+    @property
+    def columns(self):
+        """Column names, read from the cache metadata only."""
+        path = self.build()
+        if pq is not None:
+            return pq.read_schema(path).names
+        with open(path / 'columns.json') as f:
+            return json.load(f)
+
+    def load(self, columns=None):
+        """The dataset as a DataFrame, with only the given columns if any."""
+        path = self.build()
+        if pq is not None:
+            return pandas.read_parquet(path, columns=columns)
+        names = self.columns
+        wanted = names if columns is None else columns
+        missing = [column for column in wanted if column not in names]
+        if missing:
+            raise KeyError(f'{self.name} has no column(s) {", ".join(missing)}')
+        return pandas.DataFrame({column: pandas.read_pickle(path / f'{names.index(column)}.pkl')
+                                 for column in wanted})
+
+    def __getitem__(self, column):
+        return self.load([column])[column]
+
+
+def dataset(name):
+    """Lazy handle on a catalog dataset (see Dataset)."""
+    return Dataset(name)
+
+
+def load(name, columns=None):
+    """Load a catalog dataset, or only some of its columns."""
+    return Dataset(name).load(columns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List the data catalog or build its columnar cache.')
+    parser.add_argument('--build', nargs='*', default=None, metavar='NAME',
+                        help='build the cache of these datasets (all if no name is given)')
+    args = parser.parse_args()
+
+    print(f'cache format: {"parquet" if pq is not None else "pickled columns (install pyarrow for parquet)"}')
+    if args.build is not None:
+        for name in args.build or sorted(CATALOG):
+            print(f'{name}: {Dataset(name).build().relative_to(DATA_DIR.parent)}')
+    else:
+        for name in sorted(CATALOG):
+            ds = Dataset(name)
+            print(f'{name:26} {ds.spec["path"]:48} {"cached" if ds.is_cached() else "-"}')
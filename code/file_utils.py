@@ -0,0 +1,32 @@
+"""File helpers shared by the scripts in code/."""
+
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+
+def file_digest(filename):
+    """SHA-256 of a file's content, read in blocks."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_json_atomic(path, data, **kwargs):
+    """
+    Write JSON (indent=1 unless given) via a temporary file and os.replace,
+    so an interrupted run leaves the old file or the new one, never a partial one.
+    """
+    kwargs.setdefault('indent', 1)
+    fd, tmp = tempfile.mkstemp(dir=Path(path).parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, **kwargs)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
@@ -0,0 +1,235 @@
+"""
+Parse an undirected edge list (such as data/04/facebook_combined.txt, used
+in 03-SummarizingData.Rmd) once into a CSR adjacency stored as .npy files,
+with its degree distribution and summary statistics.
+
+The output directory holds indptr.npy, indices.npy and degree.npy (the
+neighbours of node i are indices[indptr[i]:indptr[i + 1]]), plus
+degree_distribution.csv and stats.json. The edge list is read in chunks
+and the arrays are built in memory-mapped files, so memory use stays at a
+few chunks of edges plus one counter per node, even for edge lists with
+hundreds of millions of lines. It is rebuilt only when the content of the
+edge list changes.
+
+degree is the undirected degree: the number of lines a node appears on,
+in either column. 03-SummarizingData.Rmd instead counts friends with
+group_by(V1), i.e. only the lines a node appears on first, and leaves out
+nodes that never do. That count is kept as v1_degree.npy, with its own
+v1_degree_distribution.csv and v1_* statistics.
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas
+
+from file_utils import file_digest, write_json_atomic
+
+ARRAYS = ['indptr', 'indices', 'degree', 'v1_degree']
+
+
+def read_edges(filename, chunksize=10000000):
+    """Read a whitespace-separated edge list ("node node" per line) as chunks of int64 arrays."""
+    for chunk in pandas.read_csv(filename, sep=r'\s+', header=None, names=['source', 'target'],
+                                 usecols=[0, 1], dtype='int64', chunksize=chunksize):
+        yield chunk.source.to_numpy(), chunk.target.to_numpy()
+
+
+def add_counts(counts, nodes):
+    """Add the number of occurrences of each node id to counts, growing it as needed."""
+    new = np.bincount(nodes)
+    if len(new) > len(counts):
+        new[:len(counts)] += counts
+        return new
+    counts[:len(new)] += new
+    return counts
+
+
+def build_csr(edgefile, outdir, chunksize=10000000):
+    """
+    Convert an undirected edge list into a CSR adjacency in outdir:
+
+    1. parse the text in chunks, spooling the edges to a binary scratch file
+       and counting the degree of each node;
+    2. allocate indices from the cumulative degrees and scatter each chunk
+       of the scratch file into place, in both directions;
+    3. sort the neighbours of each node, a block of rows at a time.
+
+    Node ids are the integers in the file, so nodes 0..max id all get a row.
+    A self-loop is stored (and adds to the degree) once; duplicate lines
+    give duplicate entries.
+
+    Returns:
+        (edges, self-loops)
+    """
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    scratch = outdir / 'edges.tmp'
+    degree = np.zeros(0, dtype=np.int64)
+    v1_degree = np.zeros(0, dtype=np.int64)
+    nedges = loops = 0
+    try:
+        with open(scratch, 'wb') as f:
+            for source, target in read_edges(edgefile, chunksize):
+                if len(source) and min(source.min(), target.min()) < 0:
+                    raise ValueError(f'{edgefile} has negative node ids')
+                np.stack([source, target], axis=1).tofile(f)
+                degree = add_counts(degree, source)
+                degree = add_counts(degree, target[target != source])
+                v1_degree = add_counts(v1_degree, source)
+                nedges += len(source)
+                loops += int((source == target).sum())
+
+        nnodes = len(degree)
+        indptr = np.lib.format.open_memmap(outdir / 'indptr.npy', mode='w+', dtype=np.int64,
+                                           shape=(nnodes + 1,))
+        indptr[0] = 0
+        np.cumsum(degree, out=indptr[1:])
+        index_dtype = np.int32 if nnodes <= np.iinfo(np.int32).max else np.int64
+        indices = np.lib.format.open_memmap(outdir / 'indices.npy', mode='w+', dtype=index_dtype,
+                                            shape=(int(indptr[-1]),))
+
+        # next free slot of each row
+        cursor = np.array(indptr[:-1])
+        if nedges:
+            edges = np.memmap(scratch, dtype=np.int64, mode='r', shape=(nedges, 2))
+            for start in range(0, nedges, chunksize):
+                source, target = np.array(edges[start:start + chunksize]).T
+                mirror = source != target
+                rows = np.concatenate([source, target[mirror]])
+                cols = np.concatenate([target, source[mirror]])
+                # the k-th entry of a row in this chunk goes to slot cursor[row] + k
+                by_row = np.argsort(rows, kind='stable')
+                rows, cols = rows[by_row], cols[by_row]
+                rank = np.arange(len(rows)) - np.searchsorted(rows, rows, side='left')
+                indices[cursor[rows] + rank] = cols
+                cursor += np.bincount(rows, minlength=nnodes)
+            del edges
+
+        sort_rows(indptr, indices, chunksize)
+        indptr.flush()
+        indices.flush()
+        np.save(outdir / 'degree.npy', degree)
+        v1_degree = np.concatenate([v1_degree, np.zeros(nnodes - len(v1_degree), dtype=np.int64)])
+        np.save(outdir / 'v1_degree.npy', v1_degree)
+    finally:
+        if scratch.exists():
+            scratch.unlink()
+    return nedges, loops
+
+
+def sort_rows(indptr, indices, chunksize=10000000):
+    """Sort the neighbours within each row, in blocks of rows holding about chunksize entries."""
+    nnodes = len(indptr) - 1
+    row = 0
+    while row < nnodes:
+        end = int(np.searchsorted(indptr, indptr[row] + chunksize, side='right')) - 1
+        end = min(max(end, row + 1), nnodes)
+        lo, hi = int(indptr[row]), int(indptr[end])
+        if hi > lo:
+            rows = np.repeat(np.arange(row, end), np.diff(indptr[row:end + 1]))
+            block = np.array(indices[lo:hi])
+            indices[lo:hi] = block[np.lexsort((block, rows))]
+        row = end
+
+
+def load_csr(outdir, mmap=True):
+    """
+    The arrays of a graph directory, as read-only memory maps by default,
+    so a large adjacency is only read from disk where it is used.
+
+    Returns:
+        (indptr, indices, degree, v1_degree)
+    """
+    mode = 'r' if mmap else None
+    return tuple(np.load(Path(outdir) / f'{name}.npy', mmap_mode=mode) for name in ARRAYS)
+
+
+def degree_distribution(degree):
+    """Number of nodes with each degree, for the degrees that occur."""
+    counts = np.bincount(degree)
+    present = np.flatnonzero(counts)
+    return pandas.DataFrame({'degree': present, 'nodes': counts[present]})
+
+
+def graph_stats(degree, v1_degree, nedges, loops):
+    """
+    Summary statistics of a graph with the given node degrees. The v1_*
+    statistics are over the nodes that appear in the first column, like
+    the friends table of 03-SummarizingData.Rmd.
+    """
+    nnodes = len(degree)
+    if not nnodes:
+        return {'nodes': 0, 'edges': nedges, 'self_loops': loops}
+    listed = v1_degree[v1_degree > 0]
+    return {
+        'nodes': nnodes,
+        'edges': nedges,
+        'self_loops': loops,
+        'isolated_nodes': int((degree == 0).sum()),
+        'density': 2 * (nedges - loops) / (nnodes * (nnodes - 1)) if nnodes > 1 else 0.0,
+        'degree_min': int(degree.min()),
+        'degree_max': int(degree.max()),
+        'degree_mean': float(degree.mean()),
+        'degree_median': float(np.median(degree)),
+        'degree_std': float(degree.std()),
+        'v1_nodes': len(listed),
+        'v1_degree_max': int(listed.max()) if len(listed) else 0,
+        'v1_degree_mean': float(listed.mean()) if len(listed) else 0.0,
+        'v1_degree_median': float(np.median(listed)) if len(listed) else 0.0,
+    }
+
+
+def load_stats(outdir):
+    with open(Path(outdir) / 'stats.json') as f:
+        return json.load(f)
+
+
+def prepare_graph(edgefile, outdir, chunksize=10000000, force=False):
+    """
+    Build the CSR adjacency, degree distribution and statistics of an edge
+    list, unless outdir already holds them for the same file content.
+
+    Returns:
+        (stats dict, whether the graph was rebuilt)
+    """
+    outdir = Path(outdir)
+    digest = file_digest(edgefile)
+    if not force and (outdir / 'stats.json').exists():
+        stats = load_stats(outdir)
+        if stats.get('source_sha256') == digest and all((outdir / f'{name}.npy').exists() for name in ARRAYS):
+            return stats, False
+
+    # stats.json marks a complete directory, so drop it while the arrays are rewritten
+    (outdir / 'stats.json').unlink(missing_ok=True)
+    nedges, loops = build_csr(edgefile, outdir, chunksize)
+    degree = np.load(outdir / 'degree.npy')
+    v1_degree = np.load(outdir / 'v1_degree.npy')
+    degree_distribution(degree).to_csv(outdir / 'degree_distribution.csv', index=False)
+    degree_distribution(v1_degree[v1_degree > 0]).to_csv(outdir / 'v1_degree_distribution.csv', index=False)
+    stats = graph_stats(degree, v1_degree, nedges, loops)
+    stats['source'] = os.path.basename(edgefile)
+    stats['source_sha256'] = digest
+    # written last, so its presence means the rest of the directory is complete
+    write_json_atomic(outdir / 'stats.json', stats)
+    return stats, True
+
+
+if __name__ == '__main__':
+    repo = Path(__file__).resolve().parent.parent
+    parser = argparse.ArgumentParser(description='Convert an edge list into a CSR adjacency with degree statistics.')
+    parser.add_argument('edgefile', nargs='?', type=Path, default=repo / 'data/04/facebook_combined.txt')
+    parser.add_argument('outdir', nargs='?', type=Path, default=None,
+                        help='output directory (default: the edge list path with a .csr suffix)')
+    parser.add_argument('--chunksize', type=int, default=10000000, help='edges processed at a time')
+    parser.add_argument('--force', action='store_true', help='rebuild even if the edge list is unchanged')
+    args = parser.parse_args()
+
+    outdir = args.outdir or args.edgefile.with_suffix('.csr')
+    stats, rebuilt = prepare_graph(args.edgefile, outdir, args.chunksize, args.force)
+    print(f'{"wrote" if rebuilt else "up to date:"} {outdir}')
+    print(f'{stats["nodes"]} nodes, {stats["edges"]} edges, '
+          f'degree mean {stats.get("degree_mean", 0):.2f} (max {stats.get("degree_max", 0)})')
@@ -1,6 +1,181 @@
+import argparse
+import json
+import os
+
 import pandas
 
-data=pandas.read_csv('CT-clean.csv')
-dataSmall=data.filter(['driver_race','search_conducted'], axis=1)
-dataSmall=dataSmall.loc[dataSmall.driver_race.isin(['White','Black'])]
-dataSmall.to_csv('CT_data_cleaned.csv')
+from file_utils import file_digest, write_json_atomic
+
+COLUMNS = ['driver_race', 'search_conducted']
+RACES = ['White', 'Black']
+
+# stratification for the contingency counts: name -> (source column, dtype)
+STRATA = {
+    'year': ('stop_date', 'str'),
+    'department': ('police_department', 'category'),
+}
+
+
+def read_stops(filename, chunksize=100000, by=None):
+    """
+    Read the stop file in chunks of rows, parsing only the columns we keep:
+    driver_race as a categorical and search_conducted as a (nullable)
+    boolean, plus the source column of the stratum `by`, if any.
+    """
+    dtype = {'driver_race': 'category', 'search_conducted': 'boolean'}
+    if by:
+        column, column_dtype = STRATA[by]
+        dtype[column] = column_dtype
+    return pandas.read_csv(filename, usecols=list(dtype), chunksize=chunksize, dtype=dtype)
+
+
+def filter_stops(chunk):
+    return chunk.loc[chunk.driver_race.isin(RACES)]
+
+
+def count_key(values, name):
+    """Values as strings ('' for missing), so counts from different files line up exactly."""
+    return values.astype('string').fillna('').rename(name)
+
+
+def count_stops(chunk, by=None):
+    """Counts of each (stratum x) driver_race x search_conducted combination in a chunk."""
+    keys = [count_key(chunk.driver_race, 'driver_race'),
+            count_key(chunk.search_conducted, 'search_conducted')]
+    if by == 'year':
+        keys.insert(0, count_key(chunk.stop_date.str[:4], 'year'))
+    elif by == 'department':
+        keys.insert(0, count_key(chunk.police_department, 'department'))
+    return chunk.groupby(keys).size()
+
+
+def process_stops(infile, outfile=None, chunksize=100000, by=None, aggregate=False):
+    """
+    Filter the stops to White and Black drivers, one chunk at a time, and
+    append each filtered chunk to outfile (if given), so memory use does not
+    grow with the size of the input. With aggregate, the contingency counts
+    (see count_stops) are summed in the same pass.
+
+    Returns:
+        (number of rows kept, counts Series, or None without aggregate or input rows)
+    """
+    rows = 0
+    counts = None
+    f = open(outfile, 'w', newline='') if outfile else None
+    try:
+        if f:
+            f.write(','.join(COLUMNS) + '\n')
+        for chunk in read_stops(infile, chunksize, by):
+            dataSmall = filter_stops(chunk)
+            if f:
+                dataSmall[COLUMNS].to_csv(f, header=False, index=False)
+            if aggregate:
+                chunk_counts = count_stops(dataSmall, by)
+                counts = chunk_counts if counts is None else counts.add(chunk_counts, fill_value=0)
+            rows += len(dataSmall)
+    finally:
+        if f:
+            f.close()
+    return rows, counts
+
+
+def sources_file(countsfile):
+    """
+    Sidecar mapping the SHA-256 of every extract already included in a
+    counts file to the path it was read from.
+    """
+    return countsfile + '.sources.json'
+
+
+def load_sources(countsfile):
+    """The sources of an existing counts file (see sources_file)."""
+    try:
+        with open(sources_file(countsfile)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise ValueError(f'{countsfile} has no {sources_file(countsfile)}, so the extracts it already '
+                         'includes are unknown; rebuild it from the full data with --counts') from None
+
+
+def load_counts(countsfile):
+    """Read a counts file written by save_counts back into a Series."""
+    counts = pandas.read_csv(countsfile, dtype=str, keep_default_na=False)
+    return counts.set_index(list(counts.columns[:-1]))['count'].astype('int64')
+
+
+def save_counts(countsfile, counts, sources):
+    """
+    Write the counts as a long table (stratum, driver_race, search_conducted,
+    count), sorted so that reruns give the same file, and the list of
+    included sources next to it.
+    """
+    table = counts.astype('int64').rename('count').reset_index()
+    table = table.sort_values(list(table.columns[:-1]))
+    table.to_csv(countsfile, index=False)
+    write_json_atomic(sources_file(countsfile), sources)
+
+
+def update_counts(countsfile, infiles, chunksize=100000, by=None):
+    """
+    Add the counts of new extracts (e.g. a monthly file) to an existing
+    counts file. Extracts whose content was already counted are skipped,
+    so rerunning an update does not count anything twice.
+    """
+    sources = {}
+    counts = None
+    if os.path.exists(countsfile):
+        sources = load_sources(countsfile)
+        counts = load_counts(countsfile)
+    for infile in infiles:
+        digest = file_digest(infile)
+        if digest in sources:
+            print(f'{infile} is already counted, skipping')
+            continue
+        _, new_counts = process_stops(infile, None, chunksize, by, aggregate=True)
+        if new_counts is None:
+            pass
+        elif counts is None:
+            counts = new_counts
+        elif counts.index.names != new_counts.index.names:
+            raise ValueError(f'{countsfile} has counts by {counts.index.names}, not {new_counts.index.names}')
+        else:
+            counts = counts.add(new_counts, fill_value=0)
+        sources[digest] = os.path.abspath(infile)
+    if counts is not None:
+        save_counts(countsfile, counts, sources)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reduce the CT stop data to driver race and search outcome.')
+    parser.add_argument('infile', nargs='?', default='CT-clean.csv')
+    parser.add_argument('outfile', nargs='?', default='CT_data_cleaned.csv')
+    parser.add_argument('--chunksize', type=int, default=100000, help='rows read at a time')
+    parser.add_argument('--counts', default=None, metavar='CSV',
+                        help='also write the driver_race x search_conducted contingency counts to this file')
+    parser.add_argument('--by', choices=sorted(STRATA), default=None,
+                        help='stratify the counts by stop year or police department')
+    parser.add_argument('--counts-only', action='store_true',
+                        help='write only the counts, not the row-level outfile')
+    parser.add_argument('--update', nargs='+', default=None, metavar='EXTRACT',
+                        help='add the counts of these new extracts to the --counts file instead of '
+                             'reprocessing infile; extracts counted before are skipped')
+    args = parser.parse_args()
+
+    if (args.update or args.counts_only) and not args.counts:
+        parser.error('--update and --counts-only need --counts')
+    if args.update:
+        try:
+            counts = update_counts(args.counts, args.update, args.chunksize, args.by)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        print(f'{args.counts} now holds {int(counts.sum()) if counts is not None else 0} stops')
+    else:
+        outfile = None if args.counts_only else args.outfile
+        rows, counts = process_stops(args.infile, outfile, args.chunksize, args.by,
+                                     aggregate=bool(args.counts))
+        if outfile:
+            print(f'wrote {rows} stops to {outfile}')
+        if args.counts and counts is not None:
+            save_counts(args.counts, counts, {file_digest(args.infile): os.path.abspath(args.infile)})
+            print(f'wrote counts of {rows} stops to {args.counts}')
@@ -0,0 +1,209 @@
+# create time-resolved (sliding window) connectivity matrices from timeseries data
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from functools import partial
+from pathlib import Path
+
+from prepare_connectivity import ensure_cached, map_files, parcel_order, read_timeseries
+
+
+class WindowStatistics:
+    """
+    Sums and cross products of the rows currently in a window, in float64
+    and relative to a fixed shift (close to the data mean), so rows can be
+    added and removed as the window slides without recomputing everything.
+    """
+
+    def __init__(self, shift):
+        self.shift = np.asarray(shift, dtype=np.float64)
+        self.reset()
+
+    def reset(self, rows=None):
+        """Start over, optionally with a block of rows."""
+        nparcels = len(self.shift)
+        self.n = 0
+        self.sums = np.zeros(nparcels)
+        self.cross = np.zeros((nparcels, nparcels))
+        if rows is not None:
+            self.add(rows)
+
+    def add(self, rows):
+        rows = np.asarray(rows, dtype=np.float64) - self.shift
+        self.n += len(rows)
+        self.sums += rows.sum(axis=0)
+        self.cross += rows.T @ rows
+
+    def remove(self, rows):
+        rows = np.asarray(rows, dtype=np.float64) - self.shift
+        self.n -= len(rows)
+        self.sums -= rows.sum(axis=0)
+        self.cross -= rows.T @ rows
+
+    def corrcoef(self):
+        """Correlation matrix of the rows in the window, like np.corrcoef."""
+        cov = self.cross - np.outer(self.sums, self.sums) / self.n
+        stddev = np.sqrt(np.diag(cov))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cc = cov / stddev[:, None] / stddev[None, :]
+        np.clip(cc, -1, 1, out=cc)
+        return cc
+
+
+def n_windows(nrows, window, step=1):
+    """Number of complete windows in a timeseries of nrows timepoints."""
+    return max(0, (nrows - window) // step + 1) if window >= 2 else 0
+
+
+def sliding_window_corr(tsdata, window, step=1, refresh=100):
+    """
+    Yield (start, correlation matrix) for each window tsdata[start:start + window],
+    with start = 0, step, 2 * step, ...
+
+    Each slide subtracts the rows that leave the window and adds the ones
+    that enter it, which costs step instead of window rows. The statistics
+    are rebuilt from the window itself every refresh slides (and whenever
+    step >= window) so that rounding errors cannot accumulate.
+    """
+    if step < 1 or refresh < 1:
+        raise ValueError('step and refresh must be at least 1')
+    nrows = len(tsdata)
+    if not n_windows(nrows, window, step):
+        return
+    stats = WindowStatistics(tsdata[:window].mean(axis=0, dtype=np.float64))
+    stats.add(tsdata[:window])
+    slides = 0
+    for start in range(0, nrows - window + 1, step):
+        if start:
+            slides += 1
+            if step >= window or slides % refresh == 0:
+                stats.reset(tsdata[start:start + window])
+            else:
+                stats.remove(tsdata[start - step:start])
+                stats.add(tsdata[start - step + window:start + window])
+        yield start, stats.corrcoef()
+
+
+def dynamic_ccmtx(sessions, window, step=1, order=None, refresh=100):
+    """
+    Sliding-window correlation matrices for each session in turn; windows
+    do not span two sessions. Sessions given as file paths are parsed when
+    their turn comes, so only one is in memory at a time. With an order
+    (see parcel_order), the parcels of every matrix are sorted by it.
+
+    Yields:
+        (session index, window start, correlation matrix)
+    """
+    for i, tsdata in enumerate(sessions):
+        if not isinstance(tsdata, np.ndarray):
+            tsdata = read_timeseries(tsdata)
+        if order is not None:
+            tsdata = tsdata[:, order]
+        for start, cc in sliding_window_corr(tsdata, window, step, refresh):
+            yield i, start, cc
+
+
+def session_shape(tsfile):
+    """
+    (timepoints, parcels) of a timeseries file, from its data lines (not
+    blank or comment-only, as read_timeseries skips them) without parsing
+    the values.
+    """
+    rows = ncols = 0
+    with open(tsfile, 'rb') as f:
+        for line in f:
+            line = line.split(b'#', 1)[0]
+            if line.strip():
+                ncols = ncols or len(line.split())
+                rows += 1
+    return rows, ncols
+
+
+def load_sessions(tsfiles, workers=1, cache_dir=None):
+    """
+    Find the non-empty sessions. With a cache_dir they are memory maps of
+    their .npy cache entries (created in parallel with workers > 1), so
+    they take no memory until windows are computed from them. Without one
+    they are the file paths, which dynamic_ccmtx parses one at a time.
+
+    Returns:
+        (files, sessions, shapes) for the non-empty files
+    """
+    if cache_dir is not None:
+        entries = map_files(partial(ensure_cached, cache_dir=cache_dir), tsfiles, workers)
+        sessions = [np.load(entry, mmap_mode='r') for entry in entries]
+        shapes = [tsdata.shape for tsdata in sessions]
+    else:
+        sessions = list(tsfiles)
+        shapes = list(map_files(session_shape, tsfiles, workers))
+    loaded = [item for item in zip(tsfiles, sessions, shapes) if item[2][0]]
+    return [f for f, _, _ in loaded], [tsdata for _, tsdata, _ in loaded], [shape for _, _, shape in loaded]
+
+
+def write_dynamic_ccmtx(output, tsfiles, sessions, shapes, window, step=1, order=None, upper=False,
+                        dtype=np.float32, refresh=100):
+    """
+    Stream all window matrices into an .npy file of shape (windows, n, n),
+    or (windows, n * (n + 1) / 2) with upper=True, without holding more than
+    one session and one matrix in memory. shapes are the (timepoints,
+    parcels) of the sessions, as returned by load_sessions. The session file
+    and the first and last timepoint of each window go to <name>.windows.csv.
+    """
+    output = Path(output)
+    nparcels = shapes[0][1] if order is None else len(order)
+    counts = [n_windows(nrows, window, step) for nrows, _ in shapes]
+    shape = (nparcels * (nparcels + 1) // 2,) if upper else (nparcels, nparcels)
+    print(f'writing {sum(counts)} windows of {window} timepoints to {output}')
+    out = np.lib.format.open_memmap(output, mode='w+', dtype=dtype, shape=(sum(counts),) + shape)
+    triu = np.triu_indices(nparcels) if upper else None
+
+    index = []
+    for k, (i, start, cc) in enumerate(dynamic_ccmtx(sessions, window, step, order, refresh)):
+        out[k] = cc[triu] if upper else cc
+        index.append((Path(tsfiles[i]).name, start, start + window))
+    out.flush()
+    pd.DataFrame(index, columns=['file', 'start', 'stop']).to_csv(
+        output.with_name(output.stem + '.windows.csv'), index=False)
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Create sliding-window MyConnectome connectivity matrices.')
+    parser.add_argument('--tsdir', type=Path, default=Path('/data/myconnectome/combined_data_scrubbed'),
+                        help='directory of timeseries .txt files')
+    parser.add_argument('--parcels', type=Path, default=Path('parcel_data.txt'),
+                        help='parcel table used to sort the matrices by hemisphere and network')
+    parser.add_argument('-o', '--output', type=Path, default=Path('ccmtx_dynamic.npy'),
+                        help='output .npy file; window positions go to <name>.windows.csv')
+    parser.add_argument('--window', type=int, required=True, help='window length in timepoints')
+    parser.add_argument('--step', type=int, default=1, help='timepoints between window starts')
+    parser.add_argument('--upper', action='store_true',
+                        help='store only the upper triangle (with the diagonal) of each matrix')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float64'],
+                        help='dtype of the stored matrices (default: float32)')
+    parser.add_argument('--refresh', type=int, default=100,
+                        help='recompute the window statistics from scratch every this many slides')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes parsing timeseries files (0 = one per CPU core)')
+    parser.add_argument('--cache-dir', type=Path, default=None,
+                        help='.npy cache of the parsed timeseries files (see prepare_connectivity.py)')
+    args = parser.parse_args()
+    if args.window < 2:
+        parser.error('--window must be at least 2')
+    if args.step < 1 or args.refresh < 1:
+        parser.error('--step and --refresh must be at least 1')
+    if args.workers == 0:
+        args.workers = os.cpu_count() or 1
+
+    tsfiles = sorted(args.tsdir.glob('*.txt'))
+    print(f'found {len(tsfiles)} timeseries files')
+    tsfiles, sessions, shapes = load_sessions(tsfiles, args.workers, args.cache_dir)
+    if not sessions:
+        raise SystemExit('no timeseries data found')
+    order, _ = parcel_order(args.parcels)
+    write_dynamic_ccmtx(args.output, tsfiles, sessions, shapes, args.window, args.step, order, args.upper,
+                        np.dtype(args.dtype), args.refresh)
@@ -0,0 +1,142 @@
+# permutation tests for the edges of the connectivity matrix, with family-wise error control
+
+import argparse
+import os
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from prepare_connectivity import load_timeseries, parcel_order, standardize_columns, write_blocks
+
+
+# data shared by the batches of one run; set in each worker process by _init_worker
+_z = None
+_observed = None
+
+
+def _init_worker(z, observed):
+    global _z, _observed
+    _z = z
+    _observed = observed
+
+
+def resample(z, rng, method='permute'):
+    """
+    One null dataset: each parcel's timeseries is independently shuffled
+    ('permute') or circularly shifted by a random lag ('shift', which keeps
+    its autocorrelation), so all true correlations between parcels are broken.
+    """
+    nrows, ncols = z.shape
+    if method == 'shift':
+        index = (np.arange(nrows)[:, None] + rng.integers(0, nrows, size=ncols)) % nrows
+    else:
+        index = rng.permuted(np.broadcast_to(np.arange(nrows)[:, None], (nrows, ncols)), axis=0)
+    return np.take_along_axis(z, index, axis=0)
+
+
+def null_batch(task):
+    """
+    Correlation matrices for one batch of resamples, computed with a single
+    batched matrix product, reduced to the maximum |r| over the edges of
+    each resample and to per-edge counts of |r| >= the observed |r|.
+
+    Args:
+        task: Tuple (seed, size, method); seed is a SeedSequence, so the
+            batch is the same whichever process runs it
+
+    Returns:
+        (maxima of shape (size,), counts of shape (n, n))
+    """
+    seed, size, method = task
+    rng = np.random.default_rng(seed)
+    zb = np.stack([resample(_z, rng, method) for _ in range(size)])
+    null = np.abs(np.matmul(zb.transpose(0, 2, 1), zb))
+    # the diagonal is not an edge
+    diag = np.arange(null.shape[1])
+    null[:, diag, diag] = 0
+    return null.max(axis=(1, 2)), (null >= _observed).sum(axis=0)
+
+
+def batch_tasks(permutations, batch, seed, method):
+    """Split the resamples into batches, each with its own child seed of one SeedSequence."""
+    sizes = [min(batch, permutations - start) for start in range(0, permutations, batch)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    return [(child, size, method) for child, size in zip(seeds, sizes)]
+
+
+def permutation_test(tsdata, permutations=1000, batch=8, seed=0, method='permute', workers=1, order=None):
+    """
+    Edge-wise permutation test of the correlation matrix of tsdata
+    (timepoints x parcels), with p-values corrected for the family-wise
+    error over all edges by the max-statistic method.
+
+    Resamples are generated and reduced in batches, in a process pool when
+    workers > 1. Batch b always uses the b-th child of SeedSequence(seed)
+    and results are reduced in batch order, so the output depends only on
+    seed, permutations and batch, not on workers.
+
+    Returns:
+        Dict with 'ccmtx' (observed correlations), 'p_fwe' (FWE-corrected
+        p-values), 'p_uncorrected' and 'null_max' (max |r| of each resample),
+        with parcels sorted by order if given
+    """
+    z = standardize_columns(tsdata, order=order)
+    cc = np.clip(z.T @ z, -1, 1)
+    observed = np.abs(cc)
+    np.fill_diagonal(observed, np.inf)
+
+    tasks = batch_tasks(permutations, batch, seed, method)
+    if workers <= 1:
+        _init_worker(z, observed)
+        results = list(map(null_batch, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(z, observed)) as pool:
+            results = list(pool.map(null_batch, tasks))
+
+    null_max = np.concatenate([maxima for maxima, _ in results])
+    counts = sum(counts for _, counts in results)
+    # number of resamples whose maximum reaches each observed |r|
+    exceed = len(null_max) - np.searchsorted(np.sort(null_max), observed, side='left')
+    p_fwe = (exceed + 1) / (len(null_max) + 1)
+    p_uncorrected = (counts + 1) / (len(null_max) + 1)
+    for p in (p_fwe, p_uncorrected):
+        np.fill_diagonal(p, np.nan)
+    return {'ccmtx': cc, 'p_fwe': p_fwe, 'p_uncorrected': p_uncorrected, 'null_max': null_max}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Permutation test the edges of the MyConnectome connectivity matrix.')
+    parser.add_argument('--tsdir', type=Path, default=Path('/data/myconnectome/combined_data_scrubbed'),
+                        help='directory of timeseries .txt files')
+    parser.add_argument('--parcels', type=Path, default=Path('parcel_data.txt'),
+                        help='parcel table used to sort the matrices by hemisphere and network')
+    parser.add_argument('-o', '--output', type=Path, default=Path('ccmtx_permutation.npz'),
+                        help='output .npz with ccmtx, p_fwe, p_uncorrected and null_max')
+    parser.add_argument('--permutations', type=int, default=1000, help='number of resamples')
+    parser.add_argument('--batch', type=int, default=8,
+                        help='resamples per batched matrix product (memory grows with it)')
+    parser.add_argument('--method', default='permute', choices=['permute', 'shift'],
+                        help='shuffle each timeseries, or shift it circularly to keep its autocorrelation')
+    parser.add_argument('--seed', type=int, default=0, help='random seed; the result is the same for any --workers')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes (0 = one per CPU core)')
+    parser.add_argument('--cache-dir', type=Path, default=None,
+                        help='.npy cache of the parsed timeseries files (see prepare_connectivity.py)')
+    args = parser.parse_args()
+    if args.workers == 0:
+        args.workers = os.cpu_count() or 1
+
+    tsfiles = sorted(args.tsdir.glob('*.txt'))
+    print(f'found {len(tsfiles)} timeseries files')
+    tsdata = load_timeseries(tsfiles, workers=args.workers, cache_dir=args.cache_dir)
+    order, blocks = parcel_order(args.parcels)
+    print(f'running {args.permutations} {args.method} resamples in batches of {args.batch}')
+    result = permutation_test(tsdata, args.permutations, args.batch, args.seed, args.method,
+                              args.workers, order)
+    np.savez_compressed(args.output, order=order + 1, **result)
+    write_blocks(args.output, order, blocks)
+    p_fwe = result['p_fwe'][np.triu_indices(len(order), 1)]
+    print(f'{(p_fwe < 0.05).sum()} of {len(p_fwe)} edges significant at FWE p < 0.05')
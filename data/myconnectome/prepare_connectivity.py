@@ -1,36 +1,482 @@
 # create connectivity matrix from timeseries data
 
+import argparse
+import glob
+import hashlib
+import json
+import os
+import tempfile
+
 import numpy as np
 import pandas as pd
 
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
 
-def get_ccmtx(tsdir):
-    tsfiles = sorted(tsdir.glob('*.txt'))
-    print(f'found {len(tsfiles)} timeseries files')
+def count_rows(tsfile):
+    """Upper bound on the number of timepoints in a file: its line count, without parsing."""
+    lines = 0
+    last = b'\n'
+    with open(tsfile, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    return lines + (last != b'\n')
+
+
+def read_timeseries(tsfile, dtype=np.float16):
+    """
+    Parse one whitespace-delimited timeseries file (timepoints x parcels)
+    with pandas' C parser, which is far faster than the pure-Python
+    np.loadtxt of NumPy < 1.23. With float_precision='round_trip' its
+    float64 values are exactly those of np.loadtxt.
+    """
+    data = pd.read_csv(tsfile, sep=r'\s+', header=None, comment='#', dtype=np.float64, engine='c',
+                       float_precision='round_trip')
+    return data.to_numpy().astype(dtype, copy=False)
+
+
+def cache_file(tsfile, cache_dir, dtype=np.float16):
+    """
+    Path of the .npy cache entry for a timeseries file. The name is keyed by
+    the file's absolute path, size and modification time (and the dtype), so
+    an edited or replaced file gets a new entry.
+    """
+    source = str(Path(tsfile).resolve())
+    st = os.stat(source)
+    path_key = hashlib.sha256(source.encode('utf-8')).hexdigest()[:12]
+    state_key = hashlib.sha256(f'{st.st_size}:{st.st_mtime_ns}:{np.dtype(dtype).str}'.encode('ascii')).hexdigest()[:12]
+    return Path(cache_dir) / f'{Path(tsfile).stem}-{path_key}-{state_key}.npy'
+
+
+def ensure_cached(tsfile, cache_dir, dtype=np.float16):
+    """
+    Parse a timeseries file into its .npy cache entry unless it is already
+    there, removing entries for older versions of the file. Returns the entry.
+    """
+    entry = cache_file(tsfile, cache_dir, dtype)
+    if entry.exists():
+        return entry
+    if count_rows(tsfile):
+        filedata = read_timeseries(tsfile, dtype)
+    else:
+        filedata = np.empty((0, 0), dtype=dtype)
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file and rename, so readers never see a partial entry
+    fd, tmp = tempfile.mkstemp(dir=entry.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, filedata)
+        os.replace(tmp, entry)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    stem, path_key = entry.stem.rsplit('-', 2)[:2]
+    for old in entry.parent.glob(f'{glob.escape(stem)}-{path_key}-*.npy'):
+        if old != entry:
+            old.unlink(missing_ok=True)
+    return entry
+
+
+def load_cached(tsfile, cache_dir, dtype=np.float16):
+    """A timeseries file as a read-only memory map of its .npy cache entry, which is created if needed."""
+    return np.load(ensure_cached(tsfile, cache_dir, dtype), mmap_mode='r')
+
+
+def map_files(func, tsfiles, workers=1):
+    """
+    Yield func(f) for each file in file order, computed in a process pool
+    when workers > 1. Results are consumed in order, so anything reduced
+    from them is the same as in a serial run.
+    """
+    if workers <= 1 or len(tsfiles) <= 1:
+        yield from map(func, tsfiles)
+        return
+    with ProcessPoolExecutor(max_workers=min(workers, len(tsfiles))) as pool:
+        yield from pool.map(func, tsfiles)
+
+
+def load_timeseries(tsfiles, dtype=np.float16, workers=1, cache_dir=None):
+    """
+    Concatenate timeseries files into one array. The output is allocated
+    once from the line counts of all files and each file is parsed straight
+    into its rows, so loading is linear in the total size and peak memory
+    is the output plus the files being parsed.
 
+    With a cache_dir, files are parsed only if their .npy cache entry is
+    missing (in parallel with workers > 1) and the rows are copied from
+    memory maps of the entries.
+    """
+    if cache_dir is not None:
+        entries = map_files(partial(ensure_cached, cache_dir=cache_dir, dtype=dtype), tsfiles, workers)
+        loaded = [(f, np.load(entry, mmap_mode='r')) for f, entry in zip(tsfiles, entries)]
+        loaded = [(f, filedata) for f, filedata in loaded if len(filedata)]
+        capacity = sum(len(filedata) for _, filedata in loaded)
+    else:
+        counts = [count_rows(f) for f in tsfiles]
+        tsfiles = [f for f, count in zip(tsfiles, counts) if count]
+        capacity = sum(counts)
+        loaded = zip(tsfiles, map_files(partial(read_timeseries, dtype=dtype), tsfiles, workers))
     tsdata = None
-    for f in tsfiles:
-        filedata = np.loadtxt(f, dtype=np.float16)
-        tsdata = filedata if tsdata is None else np.vstack((tsdata, filedata))
+    nrows = 0
+    for f, filedata in loaded:
+        if tsdata is None:
+            print(f'allocating {capacity} x {filedata.shape[1]} {np.dtype(dtype).name} timeseries array')
+            tsdata = np.empty((capacity, filedata.shape[1]), dtype=dtype)
+        if filedata.shape[1] != tsdata.shape[1]:
+            raise ValueError(f'{f} has {filedata.shape[1]} columns, expected {tsdata.shape[1]}')
+        tsdata[nrows:nrows + len(filedata)] = filedata
+        nrows += len(filedata)
+    if tsdata is None:
+        raise ValueError('no timeseries data found')
+    return tsdata[:nrows]
+
+
+class CorrelationAccumulator:
+    """
+    Running sufficient statistics for a correlation matrix: the number of
+    timepoints, the per-parcel means and the matrix of centered cross
+    products, all in float64. Blocks are folded in with the pairwise update
+    of Chan et al., which stays accurate where raw sums and X^T X would
+    cancel catastrophically; the means are kept relative to the first
+    timepoint seen, so a large common offset costs no precision either.
+    Memory depends only on the parcel count.
+    """
+
+    def __init__(self, nparcels):
+        self.n = 0
+        self.shift = None
+        self.mean = np.zeros(nparcels)
+        self.comoment = np.zeros((nparcels, nparcels))
+
+    def update(self, block):
+        """Add a block of timepoints (rows) x parcels."""
+        block = np.asarray(block, dtype=np.float64)
+        if not len(block):
+            return
+        if self.shift is None:
+            self.shift = block[0].copy()
+        other = CorrelationAccumulator(block.shape[1])
+        other.n = len(block)
+        other.shift = self.shift
+        centered = block - self.shift
+        other.mean = centered.mean(axis=0)
+        centered -= other.mean
+        other.comoment = centered.T @ centered
+        self.merge(other)
+
+    def merge(self, other):
+        """Combine with the statistics of another, disjoint set of timepoints."""
+        if not other.n:
+            return
+        if not self.n:
+            self.n = other.n
+            self.shift = other.shift.copy()
+            self.mean = other.mean.copy()
+            self.comoment = other.comoment.copy()
+            return
+        n = self.n + other.n
+        delta = (other.mean + (other.shift - self.shift)) - self.mean
+        self.comoment += other.comoment + np.outer(delta, delta) * (self.n * other.n / n)
+        self.mean += delta * (other.n / n)
+        self.n = n
+
+    def corrcoef(self):
+        """Correlation matrix of everything added so far, like np.corrcoef."""
+        stddev = np.sqrt(np.diag(self.comoment))
+        cc = self.comoment / stddev[:, None] / stddev[None, :]
+        # clip rounding errors the way np.corrcoef does
+        np.clip(cc, -1, 1, out=cc)
+        return cc
+
+
+def file_statistics(tsfile, cache_dir=None):
+    """CorrelationAccumulator of one timeseries file, or None if it is empty."""
+    if cache_dir is not None:
+        filedata = load_cached(tsfile, cache_dir)
+    elif count_rows(tsfile):
+        filedata = read_timeseries(tsfile)
+    else:
+        return None
+    if not len(filedata):
+        return None
+    acc = CorrelationAccumulator(filedata.shape[1])
+    acc.update(filedata)
+    return acc
+
+
+def get_ccmtx_online(tsfiles, workers=1, cache_dir=None):
+    """
+    Correlation matrix over all timeseries files, reading one file at a
+    time. Per-file statistics are merged in file order whether or not they
+    are computed in parallel, so the result does not depend on workers.
+    """
+    acc = None
+    for file_acc in map_files(partial(file_statistics, cache_dir=cache_dir), tsfiles, workers):
+        if file_acc is None:
+            continue
+        if acc is None:
+            acc = CorrelationAccumulator(len(file_acc.mean))
+        acc.merge(file_acc)
+    if acc is None:
+        raise ValueError('no timeseries data found')
+    return acc.corrcoef()
+
+
+def standardize_columns(tsdata, dtype=np.float64, scratch_dir=None, order=None, rows=4096):
+    """
+    Center each column of a timepoints x parcels array and scale it to unit
+    norm, so that Z.T @ Z is the correlation matrix. Means and norms are
+    computed in float64 over blocks of rows, so the input (which may be a
+    memory map) is never converted as a whole. With a scratch_dir, Z is
+    written to a temporary disk-backed memmap there instead of to memory.
+    With an order (a permutation of the columns), Z's columns are
+    tsdata[:, order], gathered one block of rows at a time.
+    """
+    def row_block(r):
+        block = tsdata[r:r + rows]
+        return block if order is None else block[:, order]
+
+    nrows = tsdata.shape[0]
+    ncols = tsdata.shape[1] if order is None else len(order)
+    mean = np.zeros(ncols)
+    for r in range(0, nrows, rows):
+        mean += row_block(r).sum(axis=0, dtype=np.float64)
+    mean /= nrows
+    sumsq = np.zeros(ncols)
+    for r in range(0, nrows, rows):
+        centered = row_block(r) - mean
+        sumsq += np.einsum('ij,ij->j', centered, centered)
+    with np.errstate(divide='ignore'):
+        scale = 1 / np.sqrt(sumsq)
+
+    # column-major, so that a block of columns (a tile) is one contiguous
+    # stretch of memory or of the scratch file
+    if scratch_dir is None:
+        z = np.empty((nrows, ncols), dtype=dtype, order='F')
+    else:
+        # an anonymous file; the mapping keeps it alive until z is freed
+        with tempfile.TemporaryFile(dir=scratch_dir) as f:
+            z = np.memmap(f, dtype=dtype, mode='w+', shape=(nrows, ncols), order='F')
+    for r in range(0, nrows, rows):
+        with np.errstate(invalid='ignore'):
+            z[r:r + rows] = (row_block(r) - mean) * scale
+    return z
 
-    print('computing correlation matrix')
-    cc = np.corrcoef(tsdata.T)
+
+def triu_offset(n, row):
+    """Position of element (row, row) in the row-major upper triangle (with diagonal) of an n x n matrix."""
+    return row * n - row * (row - 1) // 2
+
+
+def tiled_corrcoef(tsdata, out=None, tile=1024, upper=False, dtype=np.float64, scratch_dir=None, order=None):
+    """
+    Correlation matrix of the columns of tsdata, computed tile by tile.
+
+    The columns are standardized once (see standardize_columns) and each
+    tile x tile block of the result is a single BLAS matrix product of two
+    column blocks, written straight to the output. Only blocks on or above
+    the diagonal are computed; the lower ones are their transposes.
+
+    Args:
+        tsdata: timepoints x parcels array (a memory map works)
+        out: Optional .npy path; the result is then a disk-backed memmap
+            and only a few tiles are ever held in memory
+        tile: Number of parcels per tile
+        upper: Return only the upper triangle including the diagonal, as a
+            flat row-major array of n * (n + 1) / 2 values
+            (element (i, j), i <= j, is at triu_offset(n, i) + j - i)
+        dtype: dtype of the standardized data and of the result
+        scratch_dir: Keep the standardized data in a temporary file here
+        order: Optional permutation of the parcels; the result is then the
+            matrix reordered by it, without a separate gather
+
+    Returns:
+        The correlation matrix (or its upper triangle), clipped to [-1, 1]
+        like np.corrcoef
+    """
+    n = tsdata.shape[1] if order is None else len(order)
+    shape = (n * (n + 1) // 2,) if upper else (n, n)
+    if out is None:
+        cc = np.empty(shape, dtype=dtype)
+    else:
+        cc = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+
+    z = standardize_columns(tsdata, dtype, scratch_dir, order)
+    for i0 in range(0, n, tile):
+        i1 = min(i0 + tile, n)
+        # an in-memory copy of the tile's columns, keeping z's column-major layout
+        zi = np.array(z[:, i0:i1])
+        for j0 in range(i0, n, tile):
+            j1 = min(j0 + tile, n)
+            block = zi.T @ z[:, j0:j1]
+            np.clip(block, -1, 1, out=block)
+            if upper:
+                r = np.arange(i0, i1)[:, None]
+                c = np.arange(j0, j1)[None, :]
+                keep = c >= r
+                cc[(triu_offset(n, r) + c - r)[keep]] = block[keep]
+            else:
+                cc[i0:i1, j0:j1] = block
+                if j0 != i0:
+                    cc[j0:j1, i0:i1] = block.T
+    if out is not None:
+        cc.flush()
+    return cc
+
+
+def get_ccmtx(tsdir, online=False, workers=1, cache_dir=None, tile=None, scratch_dir=None,
+              order=None, upper=False, out=None):
+    """
+    Correlation matrix of all timeseries files in tsdir, reordered by order
+    (a permutation of the parcels, see parcel_order) and reduced to the flat
+    upper triangle with upper=True. The tiled engine (tile) applies both
+    while it computes the tiles and writes to out (an .npy path, by default
+    ccmtx.npy in scratch_dir); the other modes gather the result with one
+    np.ix_ index.
+    """
+    tsfiles = sorted(tsdir.glob('*.txt'))
+    print(f'found {len(tsfiles)} timeseries files')
+
+    if online:
+        print('accumulating correlation statistics file by file')
+        cc = get_ccmtx_online(tsfiles, workers, cache_dir)
+    else:
+        tsdata = load_timeseries(tsfiles, workers=workers, cache_dir=cache_dir)
+        if tile:
+            print(f'computing correlation matrix in tiles of {tile} parcels')
+            if out is None and scratch_dir is not None:
+                out = Path(scratch_dir) / 'ccmtx.npy'
+            cc = tiled_corrcoef(tsdata, out, tile, upper, scratch_dir=scratch_dir, order=order)
+            print(cc.shape)
+            return cc
+        print('computing correlation matrix')
+        cc = np.corrcoef(tsdata.T)
+    if order is not None:
+        cc = cc[np.ix_(order, order)]
+    if upper:
+        cc = cc[np.triu_indices(len(cc))]
     print(cc.shape)
     return(cc)
 
 
-if __name__ == "__main__":
-    tsdir = Path('/data/myconnectome/combined_data_scrubbed')
+def parcel_order(parcel_file):
+    """
+    Sort the parcels by hemisphere and network.
 
-    cc = get_ccmtx(tsdir)
-    
-    # reorder based on parcel info
-    parcel_info = pd.read_csv('parcel_data.txt', sep='\t', header=None, index_col=0)
+    Returns:
+        (order, blocks): order is the 0-based permutation of the parcels
+        (row/column i of the sorted matrix is parcel order[i] + 1), blocks
+        lists the contiguous hemisphere/network runs of the sorted matrix
+        as dicts with 'hemis', 'network', 'start' and 'stop'
+    """
+    parcel_info = pd.read_csv(parcel_file, sep='\t', header=None, index_col=0)
     parcel_info.columns = ['hemis', 'X', 'Y', 'Z', 'lobe', 
                          'region', 'network', 'yeo7network', 'yeo17network']
     parcel_info_sorted = parcel_info.sort_values(by=['hemis', 'network'])
-    tmp = cc[parcel_info_sorted.index - 1, :]
-    cc_sorted = tmp[:, parcel_info_sorted.index - 1]
-    np.savetxt('ccmtx_sorted.txt', cc_sorted)
\ No newline at end of file
+    order = parcel_info_sorted.index.to_numpy() - 1
+
+    blocks = []
+    keys = list(zip(parcel_info_sorted['hemis'], parcel_info_sorted['network']))
+    for i, key in enumerate(keys):
+        if i == 0 or key != keys[i - 1]:
+            blocks.append({'hemis': key[0], 'network': key[1], 'start': i, 'stop': i + 1})
+        else:
+            blocks[-1]['stop'] = i + 1
+    return order, blocks
+
+
+def blocks_file(output):
+    """Sidecar file describing the parcel order and network blocks of a matrix file."""
+    output = Path(output)
+    return output.with_name(output.stem + '.blocks.json')
+
+
+def write_blocks(output, order, blocks, upper=False):
+    """Write the blocks_file of a sorted matrix file: the 1-based parcel order and the network blocks."""
+    with open(blocks_file(output), 'w') as f:
+        json.dump({'n': len(order), 'upper': upper, 'order': (order + 1).tolist(), 'blocks': blocks}, f, indent=1)
+
+
+def save_ccmtx(output, cc, order, blocks, upper=False):
+    """
+    Write a sorted matrix as text (.txt), NumPy (.npy) or compressed NumPy
+    (.npz, array 'ccmtx'), plus its blocks_file with the 1-based parcel
+    order and the network blocks. A matrix already written to output by the
+    tiled engine is left as it is.
+    """
+    output = Path(output)
+    if not (isinstance(cc, np.memmap) and Path(cc.filename).resolve() == output.resolve()):
+        if output.suffix == '.npy':
+            np.save(output, cc)
+        elif output.suffix == '.npz':
+            np.savez_compressed(output, ccmtx=cc)
+        else:
+            np.savetxt(output, cc)
+    write_blocks(output, order, blocks, upper)
+
+
+def load_block(output, rows, cols):
+    """
+    Load one hemisphere/network block of a saved matrix, e.g.
+    load_block('ccmtx_sorted.npy', ('L', 'DMN'), ('R', 'DMN')). A full .npy
+    matrix is memory-mapped, so only the block is read from disk.
+    """
+    with open(blocks_file(output)) as f:
+        info = json.load(f)
+    spans = {(b['hemis'], b['network']): (b['start'], b['stop']) for b in info['blocks']}
+    (r0, r1), (c0, c1) = spans[tuple(rows)], spans[tuple(cols)]
+
+    output = Path(output)
+    if output.suffix == '.npy':
+        cc = np.load(output, mmap_mode='r')
+    elif output.suffix == '.npz':
+        cc = np.load(output)['ccmtx']
+    else:
+        cc = np.loadtxt(output)
+    if not info['upper']:
+        return np.array(cc[r0:r1, c0:c1])
+
+    r, c = np.arange(r0, r1)[:, None], np.arange(c0, c1)[None, :]
+    i, j = np.minimum(r, c), np.maximum(r, c)
+    return np.asarray(cc[triu_offset(info['n'], i) + j - i])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Create the sorted MyConnectome connectivity matrix.')
+    parser.add_argument('--tsdir', type=Path, default=Path('/data/myconnectome/combined_data_scrubbed'),
+                        help='directory of timeseries .txt files')
+    parser.add_argument('--parcels', type=Path, default=Path('parcel_data.txt'),
+                        help='parcel table used to sort the matrix by hemisphere and network')
+    parser.add_argument('-o', '--output', type=Path, default=Path('ccmtx_sorted.txt'),
+                        help='output file: .txt (text), .npy or .npz (compressed); '
+                             'the parcel order and network blocks go to <name>.blocks.json')
+    parser.add_argument('--upper', action='store_true',
+                        help='store only the upper triangle (with the diagonal) as a flat array')
+    parser.add_argument('--online', action='store_true',
+                        help='accumulate statistics file by file instead of loading all timeseries '
+                             '(memory depends only on the parcel count)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes parsing timeseries files (0 = one per CPU core); '
+                             'the output is the same for any number')
+    parser.add_argument('--cache-dir', type=Path, default=None,
+                        help='keep each parsed timeseries file as a .npy file here and reuse it '
+                             'while the text file is unchanged')
+    parser.add_argument('--tile', type=int, default=None,
+                        help='compute the correlation matrix in blocks of this many parcels '
+                             '(for parcellations too large for np.corrcoef)')
+    parser.add_argument('--scratch-dir', type=Path, default=None,
+                        help='with --tile, keep the standardized data and the matrix (ccmtx.npy) '
+                             'in disk-backed memory maps in this directory')
+    args = parser.parse_args()
+    if args.workers == 0:
+        args.workers = os.cpu_count() or 1
+
+    order, blocks = parcel_order(args.parcels)
+    # the tiled engine writes an .npy output in place, already sorted
+    out = args.output if args.tile and args.output.suffix == '.npy' else None
+    cc_sorted = get_ccmtx(args.tsdir, online=args.online, workers=args.workers, cache_dir=args.cache_dir,
+                          tile=args.tile, scratch_dir=args.scratch_dir, order=order, upper=args.upper, out=out)
+    save_ccmtx(args.output, cc_sorted, order, blocks, args.upper)
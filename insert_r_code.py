@@ -4,16 +4,77 @@ Comprehensive script to extract R code chunks from Rmd files and intelligently
 add them to PreTeXt files.
 
 This script:
-- Reads Rmd files and extracts R code chunks (excluding echo=FALSE)
+- Reads Rmd files and extracts R code chunks (excluding echo=FALSE and include=FALSE)
 - Handles XML escaping properly (< > &)
 - Intelligently places code near relevant sections using heuristics
 - Preserves proper indentation for PreTeXt XML
 """
 
+import argparse
+import cProfile
+import difflib
+import hashlib
+import io
+import json
+import os
 import re
+import shutil
 import sys
+import tempfile
+import textwrap
+import time
+import traceback
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
 from pathlib import Path
-from typing import List, Dict, Optional, Tuple
+from itertools import accumulate
+from typing import Callable, Iterable, Iterator, List, Dict, Optional, Set, Tuple
+
+import pipeline_profile
+from rmd_chunks import ChunkRecord, ChunkTable, displayable_chunks
+
+BASE_DIR = Path('/home/runner/work/statsthinking21-core/statsthinking21-core')
+
+
+class WarmCache:
+    """
+    Parsed inputs kept in memory between conversions in --watch mode.
+    
+    chunks maps an Rmd file to (stat signature, displayable chunks), so an
+    unchanged Rmd file is not parsed again. anchors maps a tuple of search
+    patterns to (PreTeXt content, AnchorIndex, existing code fingerprints),
+    reused while the file content is the same as when the index was built.
+    """
+
+    def __init__(self):
+        self.chunks: Dict[Path, Tuple[Tuple, List[ChunkRecord]]] = {}
+        self.anchors: Dict[Tuple[str, ...], Tuple[str, 'AnchorIndex', Set[str]]] = {}
+
+
+_warm: Optional[WarmCache] = None
+
+
+@contextmanager
+def warm_cache(cache: Optional[WarmCache]) -> Iterator[Optional[WarmCache]]:
+    """Make a WarmCache the one used by extract_r_code_chunks and find_insertion_lines."""
+    global _warm
+    previous = _warm
+    _warm = cache
+    try:
+        yield cache
+    finally:
+        _warm = previous
+
+
+def stat_signature(path: Path) -> Optional[Tuple[int, int, int]]:
+    """(mtime in ns, size, inode) of a file, or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
 
 
 def xml_escape(text: str) -> str:
@@ -26,63 +87,30 @@ def xml_escape(text: str) -> str:
     return text
 
 
-def extract_r_code_chunks(rmd_file: Path) -> List[Dict]:
+def extract_r_code_chunks(rmd_file: Path, table: Optional[ChunkTable] = None) -> List[ChunkRecord]:
     """
-    Extract R code chunks from an Rmd file.
-    Returns list of dicts with chunk metadata and code.
+    Extract the displayable R code chunks of an Rmd file (non-empty, and
+    neither echo=FALSE/F nor include=FALSE), selected from a chunk table;
+    the table is re-tokenized only for the file if it changed.
+    Returns list of ChunkRecord objects (name, code, line_num, context_before,
+    context_after); the text fields are read from the Rmd file on access.
     """
-    chunks = []
-    
-    with open(rmd_file, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
-    # Pattern to match R code chunks: ```{r ...} ... ```
-    pattern = r'```\{r\s*([^}]*)\}(.*?)```'
-    
-    for match in re.finditer(pattern, content, re.DOTALL):
-        chunk_header = match.group(1).strip()
-        chunk_code = match.group(2).strip()
-        
-        # Skip empty chunks
-        if not chunk_code:
-            continue
-        
-        # Parse chunk options
-        chunk_name = 'unnamed'
-        has_echo_false = False
-        
-        if chunk_header:
-            # First part might be the name
-            parts = re.split(r',\s*', chunk_header)
-            if parts and '=' not in parts[0]:
-                chunk_name = parts[0].strip()
-            
-            # Check for echo=FALSE
-            if re.search(r'echo\s*=\s*FALSE', chunk_header, re.IGNORECASE):
-                has_echo_false = True
-        
-        # Skip chunks with echo=FALSE
-        if has_echo_false:
-            continue
-        
-        # Find line number
-        line_num = content[:match.start()].count('\n') + 1
-        
-        # Extract context before and after chunk
-        context_start = max(0, match.start() - 1000)
-        context_before = content[context_start:match.start()]
-        
-        context_end = min(len(content), match.end() + 500)
-        context_after = content[match.end():context_end]
-        
-        chunks.append({
-            'name': chunk_name,
-            'code': chunk_code,
-            'line_num': line_num,
-            'context_before': context_before,
-            'context_after': context_after,
-        })
-    
+    if _warm is not None:
+        # Stat before reading: a save during the read leaves a stale signature, not stale chunks
+        signature = stat_signature(rmd_file)
+        cached = _warm.chunks.get(rmd_file)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+    
+    with pipeline_profile.stage('extract') as counters:
+        # A long-running process must not map files that an editor may truncate
+        chunks = displayable_chunks(rmd_file, table, context_before=1000, context_after=500,
+                                    use_mmap=_warm is None)
+        counters['bytes_read'] += rmd_file.stat().st_size
+        counters['chunks'] += len(chunks)
+    
+    if _warm is not None:
+        _warm.chunks[rmd_file] = (signature, chunks)
     return chunks
 
 
@@ -100,20 +128,69 @@ def format_r_code_for_pretext(code: str, indent_level: int = 2) -> str:
     # Escape XML special characters
     escaped_code = xml_escape(code)
     
-    result = f'{base_indent}<program language="r">\n'
-    result += f'{inner_indent}<input>\n'
+    parts = [f'{base_indent}<program language="r">', f'{inner_indent}<input>']
     
     # Add code lines with proper indentation
     for line in escaped_code.split('\n'):
-        if line.strip():
-            result += f'{inner_indent}{line}\n'
-        else:
-            result += '\n'
+        parts.append(f'{inner_indent}{line}' if line.strip() else '')
     
-    result += f'{inner_indent}</input>\n'
-    result += f'{base_indent}</program>'
+    parts.append(f'{inner_indent}</input>')
+    parts.append(f'{base_indent}</program>')
     
-    return result
+    return '\n'.join(parts)
+
+
+def splice_lines(lines: List[str], insertions: List[Tuple[int, str]]) -> List[str]:
+    """
+    Merge blocks into a list of lines in one pass.
+    
+    Args:
+        lines: Original lines
+        insertions: (line_index, text) pairs, sorted by line_index; each text is
+            placed before lines[line_index], preceded by a blank line
+    
+    Returns:
+        New list of lines
+    """
+    merged = []
+    previous = 0
+    for insert_line, text in insertions:
+        merged.extend(lines[previous:insert_line])
+        merged.append('')
+        merged.append(text)
+        previous = insert_line
+    merged.extend(lines[previous:])
+    return merged
+
+
+def write_atomic(path: Path, text: str):
+    """
+    Replace a file's contents via a temporary file in the same directory and
+    os.replace, so readers (and interrupted runs) only ever see the old or
+    the new version.
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+        if path.exists():
+            shutil.copymode(path, tmp_name)
+        else:
+            # mkstemp creates the file as 0600; give new files the mode open() would
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_name, 0o666 & ~umask)
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def print_diff(path: Path, old_lines: List[str], new_lines: List[str]):
+    """Print a unified diff of a would-be change, labelled with the file path."""
+    diff = difflib.unified_diff(old_lines, new_lines, fromfile=f'a/{path}', tofile=f'b/{path}', lineterm='')
+    for line in diff:
+        print(line)
 
 
 def find_section_for_insertion(ptx_content: str, search_text: str, before=False) -> Optional[int]:
@@ -137,611 +214,791 @@ def find_section_for_insertion(ptx_content: str, search_text: str, before=False)
     return None
 
 
-def insert_code_blocks_in_chapter(ptx_file: Path, code_blocks: List[Tuple[str, str, int]]) -> bool:
+class PatternAutomaton:
+    """
+    Aho-Corasick automaton over a set of literal strings.
+
+    A trie of the strings with failure links, so a single left-to-right pass
+    over a text finds every occurrence of every string in time linear in the
+    text length plus the number of matches, however many strings there are.
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        # strings ending at each state, including those of its failure chain
+        self.output: List[Tuple[str, ...]] = [()]
+        self.size = 0
+        for pattern in set(patterns):
+            if not pattern:
+                continue
+            state = 0
+            for char in pattern:
+                following = self.goto[state].get(char)
+                if following is None:
+                    following = len(self.goto)
+                    self.goto[state][char] = following
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                state = following
+            self.output[state] = (pattern,)
+            self.size += 1
+
+        # Breadth-first, so the failure target (a shorter suffix) is complete first
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, following in self.goto[state].items():
+                queue.append(following)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[following] = self.goto[fallback].get(char, 0) if state else 0
+                self.output[following] += self.output[self.fail[following]]
+
+    def first_matches(self, text: str) -> Dict[str, int]:
+        """Offset of the last character of the first occurrence of each string found in text."""
+        goto, fail, output = self.goto, self.fail, self.output
+        found: Dict[str, int] = {}
+        if not self.size:
+            return found
+        state = 0
+        for pos, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                for pattern in output[state]:
+                    if pattern not in found:
+                        found[pattern] = pos
+                if len(found) == self.size:
+                    break
+        return found
+
+
+class AnchorIndex:
+    """
+    One-pass index of a PreTeXt file for answering insertion queries.
+
+    All search patterns are located with a single PatternAutomaton pass over
+    the text, and a prefix array records how many <program> blocks are open
+    at the start of each line, so every lookup afterwards is O(1).
+    """
+
+    def __init__(self, lines: List[str], patterns: List[str]):
+        self.first_line: Dict[str, int] = {}
+        self.program_depth = [0] * (len(lines) + 1)
+
+        if lines and '' in patterns:
+            self.first_line[''] = 0
+        # A pattern spanning a line break can never match within one line
+        automaton = PatternAutomaton(p for p in patterns if '\n' not in p)
+        if automaton.size:
+            # Offsets where lines 1, 2, ... start in '\n'.join(lines)
+            next_starts = list(accumulate(len(line) + 1 for line in lines))
+            for pattern, end in automaton.first_matches('\n'.join(lines)).items():
+                self.first_line[pattern] = bisect_right(next_starts, end)
+
+        depth = 0
+        for i, line in enumerate(lines):
+            depth += line.count('<program') - line.count('</program>')
+            self.program_depth[i + 1] = depth
+
+    def find(self, search_text: str, before=False) -> Optional[int]:
+        """Same contract as find_section_for_insertion, answered from the index."""
+        line = self.first_line.get(search_text)
+        if line is None:
+            return None
+        return line if before else line + 1
+
+    def inside_program(self, insert_line: int) -> bool:
+        """True if lines[:insert_line] leaves a <program> block open."""
+        return self.program_depth[insert_line] > 0
+
+
+# Body of an existing R program block: <program language="r"> <input>...</input>
+PROGRAM_INPUT = re.compile(r'<program\b[^>]*\blanguage="r"[^>]*>\s*<input>(.*?)</input>', re.DOTALL)
+
+
+def code_fingerprint(escaped_code: str) -> str:
+    """
+    Hash of an (XML-escaped) code body, ignoring the common indentation,
+    trailing whitespace and blank lines that differ between the Rmd source
+    and the block as laid out in the PreTeXt file.
+    """
+    lines = [line.rstrip() for line in textwrap.dedent(escaped_code).split('\n')]
+    normalized = '\n'.join(line for line in lines if line)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def existing_code_fingerprints(ptx_content: str) -> Set[str]:
+    """Fingerprints of every R program block already in a PreTeXt file, found in one pass."""
+    return set(code_fingerprint(match.group(1)) for match in PROGRAM_INPUT.finditer(ptx_content))
+
+
+def new_report(chapter: str = '') -> Dict:
+    """
+    Empty per-chapter result: search patterns that were inserted, skipped
+    (already present or inside a program block) or missed (no anchor found).
+    """
+    return {'chapter': chapter, 'updated': False, 'error': False,
+            'inserted': [], 'skipped': [], 'missed': [], 'log': ''}
+
+
+def insert_code_blocks_in_chapter(ptx_file: Path, code_blocks: List[Tuple[str, str, int]],
+                                  report: Optional[Dict] = None, dry_run: bool = False) -> bool:
     """
     Insert multiple code blocks into a PreTeXt file.
     
     Args:
         ptx_file: Path to PreTeXt file
         code_blocks: List of tuples (search_pattern, code, indent_level)
+        report: Optional dict from new_report() that collects the outcome per search pattern
+        dry_run: Print a unified diff of the change instead of writing the file
         
     Returns:
-        True if any insertions were made
+        True if any insertions were made (or would be, with dry_run)
     """
-    with open(ptx_file, 'r', encoding='utf-8') as f:
-        content = f.read()
+    with pipeline_profile.stage('read') as counters:
+        with open(ptx_file, 'r', encoding='utf-8') as f:
+            content = f.read()
+        counters['bytes_read'] += ptx_file.stat().st_size
     
     lines = content.split('\n')
-    insertions_made = 0
+    if report is None:
+        report = new_report()
+    
+    with pipeline_profile.stage('anchor_search'):
+        insertion_points = find_insertion_lines(content, lines, code_blocks, report)
+    
+    if not insertion_points:
+        return False
+    
+    # Blocks at the same line go in reverse order of code_blocks, as they did
+    # when each one was inserted separately from the bottom of the file up
+    insertion_points.sort(reverse=True)
+    for insert_line, _, code, indent_level, search_pattern in insertion_points:
+        print(f"  ✓ Inserted code after line {insert_line}: {search_pattern[:50]}...")
+        report['inserted'].append(search_pattern)
+    
+    with pipeline_profile.stage('format') as counters:
+        new_text = '\n'.join(splice_lines(lines, [
+            (insert_line, format_r_code_for_pretext(code, indent_level))
+            for insert_line, _, code, indent_level, _ in reversed(insertion_points)]))
+        counters['insertions'] += len(insertion_points)
+    
+    with pipeline_profile.stage('write') as counters:
+        if dry_run:
+            print_diff(ptx_file, lines, new_text.split('\n'))
+        else:
+            write_atomic(ptx_file, new_text)
+            counters['bytes_written'] += len(new_text.encode('utf-8'))
+    
+    return True
+
+
+def find_insertion_lines(content: str, lines: List[str], code_blocks: List[Tuple[str, str, int]],
+                         report: Dict) -> List[Tuple[int, int, str, int, str]]:
+    """
+    Decide where each code block goes, recording skipped and missed blocks in report.
     
-    # Process insertions in reverse order to maintain line numbers
-    # Sort by line number (descending) so we insert from bottom to top
+    Returns:
+        List of (insert_line, -position in code_blocks, code, indent_level, search_pattern)
+    """
+    # Scan the file once for every search pattern and <program> nesting depth
+    patterns = tuple(search_pattern for search_pattern, _, _ in code_blocks)
+    cached = _warm.anchors.get(patterns) if _warm is not None else None
+    if cached is not None and cached[0] == content:
+        _, index, existing_code = cached
+    else:
+        index = AnchorIndex(lines, list(patterns))
+        existing_code = existing_code_fingerprints(content)
+        if _warm is not None:
+            _warm.anchors[patterns] = (content, index, existing_code)
+    existing_code = set(existing_code)
     insertion_points = []
     
     for search_pattern, code, indent_level in code_blocks:
-        # Check if this code is already in the file
-        if xml_escape(code[:50]) in content:
+        # Check if this code is already in the file (or queued earlier in this call)
+        fingerprint = code_fingerprint(xml_escape(code))
+        if fingerprint in existing_code:
             print(f"  ⊘ Code already exists near: {search_pattern[:50]}...")
+            report['skipped'].append(search_pattern)
             continue
         
-        insert_line = find_section_for_insertion(content, search_pattern, before=False)
+        insert_line = index.find(search_pattern, before=False)
         if insert_line is None:
             print(f"  ✗ Could not find insertion point for: {search_pattern[:60]}...")
+            report['missed'].append(search_pattern)
             continue
         
         # Check if we're inside a <program> block
-        # Count opening and closing program tags before insertion point
-        content_before = '\n'.join(lines[:insert_line])
-        open_count = content_before.count('<program')
-        close_count = content_before.count('</program>')
-        
-        if open_count > close_count:
+        if index.inside_program(insert_line):
             print(f"  ⊘ Skipping - insertion point is inside existing program block: {search_pattern[:50]}...")
+            report['skipped'].append(search_pattern)
             continue
         
-        insertion_points.append((insert_line, code, indent_level, search_pattern))
-    
-    # Sort by line number (descending)
-    insertion_points.sort(key=lambda x: x[0], reverse=True)
-    
-    # Insert from bottom to top
-    for insert_line, code, indent_level, search_pattern in insertion_points:
-        formatted_code = format_r_code_for_pretext(code, indent_level)
-        lines.insert(insert_line, '')
-        lines.insert(insert_line + 1, formatted_code)
-        insertions_made += 1
-        print(f"  ✓ Inserted code after line {insert_line}: {search_pattern[:50]}...")
+        existing_code.add(fingerprint)
+        insertion_points.append((insert_line, -len(insertion_points), code, indent_level, search_pattern))
     
-    if insertions_made > 0:
-        with open(ptx_file, 'w', encoding='utf-8') as f:
-            f.write('\n'.join(lines))
-        return True
-    
-    return False
+    return insertion_points
 
 
-def process_chapter_14(rmd_file: Path, ptx_file: Path) -> bool:
-    """Process Chapter 14: General Linear Model - add displayable R code."""
-    print(f"\nProcessing Chapter 14: General Linear Model")
-    
-    chunks = extract_r_code_chunks(rmd_file)
-    print(f"Found {len(chunks)} displayable R code chunks")
-    
-    if not chunks:
-        print("  No displayable chunks found")
-        return False
-    
-    # Display found chunks
-    for chunk in chunks:
-        print(f"  - Chunk '{chunk['name']}' at line {chunk['line_num']}")
-    
-    code_blocks = []
+RULES_FILE = Path(__file__).resolve().parent / 'r_code_rules.json'
+
+
+class ChunkClassifier:
+    """
+    Compiled chunk-placement rules of one chapter.
+    
+    Every keyword of every rule goes into one alternation regex, wrapped in a
+    lookahead so matches may overlap, with longer keywords first. One scan of
+    a chunk's code gives the set of keywords it contains as a bitmask (a
+    keyword found at a position also marks the keywords it contains), and a
+    rule applies when its own mask is a subset. The first applying rule wins,
+    as in the if/elif chains this replaces.
+    """
+
+    def __init__(self, rules: List[Dict]):
+        keywords = sorted(set(keyword for rule in rules for keyword in rule['contains']),
+                          key=lambda keyword: (-len(keyword), keyword))
+        self.bits = {keyword: 1 << i for i, keyword in enumerate(keywords)}
+        # Bits to set when a keyword is found: itself and every keyword inside it
+        self.implied = {keyword: sum(bit for other, bit in self.bits.items() if other in keyword)
+                        for keyword in keywords}
+        self.pattern = (re.compile('(?=(' + '|'.join(re.escape(k) for k in keywords) + '))')
+                        if keywords else None)
+        self.rules = [(sum(self.bits[keyword] for keyword in rule['contains']), rule.get('name'),
+                       rule['after'], rule.get('indent', 2)) for rule in rules]
+
+    def keyword_mask(self, code: str) -> int:
+        """Bitmask of the rule keywords that occur in code, found in one pass."""
+        if self.pattern is None:
+            return 0
+        found = 0
+        for keyword in set(match.group(1) for match in self.pattern.finditer(code)):
+            found |= self.implied[keyword]
+        return found
+
+    def classify(self, name: str, code: str) -> Optional[Tuple[str, int]]:
+        """(after_text, indent_level) of the first rule matching a chunk, or None."""
+        found = self.keyword_mask(code)
+        for mask, rule_name, after_text, indent_level in self.rules:
+            if mask & found == mask and (rule_name is None or rule_name == name):
+                return after_text, indent_level
+        return None
+
+
+def section_heading_anchor(chunk: ChunkRecord) -> Optional[str]:
+    """Title of the last Rmd section heading shortly before a chunk (at most 40 characters)."""
+    context = chunk['context_before'][-200:]
+    for line in reversed(context.split('\n')):
+        if line.strip().startswith('#'):
+            return line.strip('#').strip()[:40]
+    return None
+
+
+def _check(condition: bool, where: str, message: str):
+    if not condition:
+        raise ValueError(f"{where}: {message}")
+
+
+def load_rules(rules_file: Path = RULES_FILE) -> List[Dict]:
+    """
+    Read and compile the declarative insertion rules (see r_code_rules.json).
     
-    # Find and prepare code blocks for insertion
-    for chunk in chunks:
-        name = chunk['name']
-        code = chunk['code']
+    Returns:
+        One dict per chapter with keys 'title', 'ptx', 'rmd' (or None),
+        'classifier' (a ChunkClassifier), 'fallback', 'list_code_chars' and
+        'examples' (dicts with 'after', 'code' as one string, 'indent' and
+        'description'), in file order
         
-        # Add code blocks to appropriate sections
-        if name == 'unnamed' and 'df <-' in code and 'tibble' in code:
-            # This is the matrix example code
-            code_blocks.append((
-                '</subsection>',  # Insert after a subsection end
-                code,
-                2  # indent level
-            ))
-        elif 'beta_hat' in code and 'ginv' in code:
-            # This is the beta calculation code
-            code_blocks.append((
-                'The challenge here is that',
-                code,
-                2
-            ))
-    
-    if code_blocks:
-        return insert_code_blocks_in_chapter(ptx_file, code_blocks)
-    
-    print("  No appropriate insertion points found")
-    return False
+    Raises:
+        ValueError: If the file is not a valid rule set
+    """
+    with open(rules_file, 'r', encoding='utf-8') as f:
+        document = json.load(f)
+    _check(isinstance(document, dict) and document.get('version') == 1, str(rules_file),
+           'expected a version 1 rule set')
+    
+    chapters = []
+    seen = set()
+    for i, chapter in enumerate(document.get('chapters', [])):
+        where = f"{rules_file}: chapters[{i}]"
+        _check('ptx' in chapter, where, "missing 'ptx'")
+        _check(chapter['ptx'] not in seen, where, f"duplicate chapter {chapter['ptx']}")
+        seen.add(chapter['ptx'])
+        rules = chapter.get('rules', [])
+        for rule in rules:
+            _check(isinstance(rule.get('contains'), list) and 'after' in rule, where,
+                   "each rule needs a 'contains' list and an 'after' text")
+        _check(chapter.get('fallback') in (None, 'section_heading'), where,
+               f"unknown fallback {chapter.get('fallback')!r}")
+        _check('rmd' in chapter or not rules, where, "'rules' need an 'rmd' file")
+        examples = []
+        for example in chapter.get('examples', []):
+            _check('after' in example and 'code' in example, where, "each example needs 'after' and 'code'")
+            code = example['code']
+            examples.append({
+                'after': example['after'],
+                'code': '\n'.join(code) if isinstance(code, list) else code,
+                'indent': example.get('indent', 2),
+                'description': example.get('description', ''),
+            })
+        chapters.append({
+            'title': chapter.get('title', chapter['ptx']),
+            'ptx': chapter['ptx'],
+            'rmd': chapter.get('rmd'),
+            'classifier': ChunkClassifier(rules),
+            'fallback': chapter.get('fallback'),
+            'list_code_chars': chapter.get('list_code_chars', 0),
+            'examples': examples,
+        })
+    return chapters
 
 
-def process_chapter_15(rmd_file: Path, ptx_file: Path) -> bool:
-    """Process Chapter 15: Comparing Means - add displayable R code."""
-    print(f"\nProcessing Chapter 15: Comparing Means")
+def process_chapter(rmd_file: Path, ptx_file: Path, chapter: Dict,
+                    report: Optional[Dict] = None, dry_run: bool = False,
+                    table: Optional[ChunkTable] = None) -> bool:
+    """
+    Add the displayable R code of an Rmd file to its PreTeXt chapter as
+    placed by the chapter's compiled rules (see load_rules). The chunks are
+    selected from table if given (see extract_r_code_chunks).
     
-    chunks = extract_r_code_chunks(rmd_file)
+    Returns:
+        True if any insertions were made (or would be, with dry_run)
+    """
+    print(f"\nProcessing {chapter['title']}")
+    
+    chunks = extract_r_code_chunks(rmd_file, table)
     print(f"Found {len(chunks)} displayable R code chunks")
     
     if not chunks:
         print("  No displayable chunks found")
         return False
     
+    width = chapter['list_code_chars']
     for chunk in chunks:
-        print(f"  - Chunk '{chunk['name']}' at line {chunk['line_num']}: {chunk['code'][:60]}...")
+        preview = f": {chunk['code'][:width]}..." if width else ''
+        print(f"  - Chunk '{chunk['name']}' at line {chunk['line_num']}{preview}")
     
     code_blocks = []
-    
+    classifier = chapter['classifier']
     for chunk in chunks:
-        code = chunk['code']
-        
-        # Bayesian t-test example
-        if 'ttestBF' in code and 'BPDiaAve' in code:
-            code_blocks.append((
-                'the Bayes factor to quantify evidence',
-                code,
-                2
-            ))
-        # Mixed model example
-        elif 'lmer' in code and 'BPsys' in code:
-            code_blocks.append((
-                'known as a <em>mixed model</em>',
-                code,
-                2
-            ))
+        placement = classifier.classify(chunk['name'], chunk['code'])
+        if placement is None and chapter['fallback'] == 'section_heading':
+            anchor = section_heading_anchor(chunk)
+            placement = (anchor, 2) if anchor else None
+        if placement is not None:
+            after_text, indent_level = placement
+            code_blocks.append((after_text, chunk['code'], indent_level))
     
     if code_blocks:
-        return insert_code_blocks_in_chapter(ptx_file, code_blocks)
+        return insert_code_blocks_in_chapter(ptx_file, code_blocks, report, dry_run)
     
-    print("  No appropriate insertion points found")
+    if classifier.rules:
+        print("  No appropriate insertion points found")
     return False
 
 
-def process_chapter_16(rmd_file: Path, ptx_file: Path) -> bool:
-    """Process Chapter 16: Multivariate Statistics - add any displayable R code."""
-    print(f"\nProcessing Chapter 16: Multivariate Statistics")
-    
-    chunks = extract_r_code_chunks(rmd_file)
-    print(f"Found {len(chunks)} displayable R code chunks")
-    
-    if not chunks:
-        print("  No displayable chunks found")
-        return False
+@contextmanager
+def profiled_task(result: Dict, settings: Dict, phase: str) -> Iterator[None]:
+    """
+    Profile one chapter task if the run asked for it: stage timings and
+    counters go to result['profile'] (--profile), and a cProfile dump to
+    <cprofile_dir>/<phase>-<chapter>.prof (--cprofile).
+    """
+    profiler = pipeline_profile.Profiler(result['chapter']) if settings.get('profile') else None
+    cprofiler = cProfile.Profile() if settings.get('cprofile_dir') else None
+    with pipeline_profile.activate(profiler):
+        if cprofiler:
+            cprofiler.enable()
+        try:
+            with pipeline_profile.stage('chapter'):
+                yield
+        finally:
+            if cprofiler:
+                cprofiler.disable()
+                cprofiler.dump_stats(str(Path(settings['cprofile_dir']) / f"{phase}-{Path(result['chapter']).stem}.prof"))
+            if profiler:
+                result['profile'] = profiler.snapshot()
+
+
+def process_chapter_task(task: Tuple[Path, Dict, Dict]) -> Dict:
+    """
+    Convert the Rmd chunks of one chapter. Used directly or as a pool worker.
     
-    for chunk in chunks:
-        print(f"  - Chunk '{chunk['name']}' at line {chunk['line_num']}")
+    Args:
+        task: Tuple (base_dir, chapter, settings), where chapter comes from
+            load_rules and settings holds the run options 'dry_run', 'profile'
+            and 'cprofile_dir', and the run's 'chunk_table' if any
+    """
+    base_dir, chapter, settings = task
+    rmd_name = chapter['rmd']
+    ptx_name = chapter['ptx']
+    rmd_file = base_dir / rmd_name
+    ptx_file = base_dir / ptx_name
+    result = new_report(ptx_name)
+    
+    if not rmd_file.exists():
+        print(f"⚠ Warning: {rmd_file} not found")
+        return result
+    
+    if not ptx_file.exists():
+        print(f"⚠ Warning: {ptx_file} not found")
+        return result
+    
+    try:
+        with profiled_task(result, settings, 'process'):
+            result['updated'] = process_chapter(rmd_file, ptx_file, chapter, result,
+                                                settings.get('dry_run', False),
+                                                settings.get('chunk_table'))
+    except Exception as e:
+        print(f"✗ Error processing {rmd_name}: {e}")
+        traceback.print_exc()
+        result['error'] = True
     
-    # Chapter 16 seems to have displayable code - let's check
-    # For now, just report what we found
-    return False
+    return result
 
 
-def process_generic_chapter(chapter_num: int, chapter_name: str, rmd_file: Path, ptx_file: Path, 
-                           insertion_rules: List[Dict]) -> bool:
+def add_example_code_task(task: Tuple[Path, str, List[Dict], Dict]) -> Dict:
     """
-    Generic processor for chapters. Takes insertion rules to map code to sections.
+    Insert the example code for one PreTeXt file. Used directly or as a pool worker.
     
     Args:
-        chapter_num: Chapter number
-        chapter_name: Chapter name for display
-        rmd_file: Path to Rmd file
-        ptx_file: Path to PreTeXt file
-        insertion_rules: List of dicts with 'keyword' and 'after_text' keys
+        task: Tuple (base_dir, ptx_name, code_list, settings), see process_chapter_task
     """
-    print(f"\nProcessing Chapter {chapter_num}: {chapter_name}")
+    base_dir, ptx_file_name, code_list, settings = task
+    ptx_file = base_dir / ptx_file_name
+    result = new_report(ptx_file_name)
     
-    chunks = extract_r_code_chunks(rmd_file)
-    print(f"Found {len(chunks)} displayable R code chunks")
+    if not ptx_file.exists():
+        return result
     
-    if not chunks:
-        print("  No displayable chunks found")
-        return False
+    print(f"\nAdding example code to {ptx_file.name}")
     
-    for chunk in chunks:
-        print(f"  - Chunk '{chunk['name']}' at line {chunk['line_num']}")
+    code_blocks = [(item['after'], item['code'], item['indent']) for item in code_list]
+    try:
+        with profiled_task(result, settings, 'examples'):
+            result['updated'] = insert_code_blocks_in_chapter(ptx_file, code_blocks, result,
+                                                              settings.get('dry_run', False))
+    except Exception as e:
+        print(f"✗ Error adding example code to {ptx_file_name}: {e}")
+        traceback.print_exc()
+        result['error'] = True
     
-    # Try to match chunks to insertion rules
-    code_blocks = []
+    return result
+
+
+def _run_captured(worker: Callable, task: Tuple) -> Dict:
+    """Run a worker with its console output captured into the result's 'log'."""
+    buffer = io.StringIO()
+    with redirect_stdout(buffer), redirect_stderr(buffer):
+        result = worker(task)
+    result['log'] = buffer.getvalue()
+    return result
+
+
+def run_chapter_tasks(worker: Callable, tasks: List[Tuple], jobs: int = 1) -> List[Dict]:
+    """
+    Run a chapter worker over tasks, serially or in a process pool.
     
-    for chunk in chunks:
-        code = chunk['code']
-        matched = False
-        
-        for rule in insertion_rules:
-            keyword = rule.get('keyword', '')
-            after_text = rule.get('after_text', '')
-            
-            if keyword in code:
-                code_blocks.append((after_text, code, 2))
-                matched = True
-                break
-        
-        if not matched:
-            # Try to find a good insertion point based on context
-            context = chunk['context_before'][-200:]
-            # Look for section headers in context
-            if '###' in context or '##' in context:
-                # Extract the section title
-                lines = context.split('\n')
-                for line in reversed(lines):
-                    if line.strip().startswith('#'):
-                        section_title = line.strip('#').strip()[:40]
-                        code_blocks.append((section_title, code, 2))
-                        break
+    Every task must target a different PreTeXt file. With jobs > 1 each
+    worker's output is captured and printed in task order, so the report is
+    the same no matter which chapter finishes first.
     
-    if code_blocks:
-        return insert_code_blocks_in_chapter(ptx_file, code_blocks)
+    Returns:
+        List of result dicts (see new_report) in task order
+    """
+    if jobs <= 1 or len(tasks) <= 1:
+        return [worker(task) for task in tasks]
     
-    return False
+    results = []
+    with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as pool:
+        for result in pool.map(_run_captured, [worker] * len(tasks), tasks):
+            print(result['log'], end='')
+            results.append(result)
+    return results
 
 
-def add_example_code_to_remaining_chapters():
-    """
-    Add example R code to chapters that don't have displayable chunks in Rmd
-    but should have code examples for educational purposes.
-    
-    Based on the task requirements, add code to:
-    - Chapter 9.3, 10.1.4, 10.3.1, 11.6, 12.3, 12.6, 12.7
-    - Chapter 13.3.1, 13.3.2, 13.7.2
-    - Chapter 14 (intro), 14.1.4, 14.2, 14.3, 14.5, 14.9
-    - Chapter 15.1-15.6, 15.8
-    - Chapter 16.3, 16.4
-    - Chapter 17.1.5, 17.1.7, 17.2
-    """
-    base_dir = Path('/home/runner/work/statsthinking21-core/statsthinking21-core')
-    
-    # Chapter-specific example code to add
-    examples = {
-        'source/ch-hypothesis-testing.ptx': [
-            {
-                'search': 'Compute the probability of the observed result',
-                'code': '''# Calculate p-value from t-statistic
-# Assuming t-statistic and degrees of freedom
-t_stat <- 2.47  # example value
-df <- 248
-p_value <- 2 * pt(-abs(t_stat), df)  # two-tailed test
-print(p_value)
-
-# Using t.test for complete analysis
-t.test(BMI ~ PhysActive, data = NHANES_sample)''',
-                'indent': 2,
-                'description': 'Chapter 9.3 - p-value calculation'
-            },
-        ],
-        'source/ch-quantifying-effects.ptx': [
-            {
-                'search': 'confidence interval',
-                'code': '''# Calculate 95% CI for mean
-mean_val <- mean(data$variable)
-se <- sd(data$variable) / sqrt(length(data$variable))
-ci_lower <- mean_val - qt(0.975, df = length(data$variable) - 1) * se
-ci_upper <- mean_val + qt(0.975, df = length(data$variable) - 1) * se
-c(ci_lower, ci_upper)''',
-                'indent': 2,
-                'description': 'Chapter 10.1.4 - CI calculation'
-            },
-            {
-                'search': 'effect size',
-                'code': '''# Calculate Cohen's d effect size
-library(effsize)
-cohen.d(BMI ~ PhysActive, data = NHANES_sample)
-
-# Manual calculation
-group1 <- NHANES_sample$BMI[NHANES_sample$PhysActive == "No"]
-group2 <- NHANES_sample$BMI[NHANES_sample$PhysActive == "Yes"]
-mean_diff <- mean(group1) - mean(group2)
-pooled_sd <- sqrt((var(group1) + var(group2)) / 2)
-cohens_d <- mean_diff / pooled_sd
-print(cohens_d)''',
-                'indent': 2,
-                'description': 'Chapter 10.3.1 - Effect size'
-            },
-        ],
-        'source/ch-bayesian-statistics.ptx': [
-            {
-                'search': 'Bayes factor',
-                'code': '''# Bayesian t-test with Bayes Factor
-library(BayesFactor)
-
-# Two-sample Bayesian t-test
-bf <- ttestBF(formula = BMI ~ PhysActive, data = NHANES_sample)
-print(bf)
-
-# Extract and interpret Bayes Factor
-bf_value <- extractBF(bf)$bf
-cat(sprintf("Bayes Factor: %.2f\\n", bf_value))
-
-# Get posterior samples
-samples <- posterior(bf, iterations = 10000)
-plot(samples[, "mu"])''',
-                'indent': 2,
-                'description': 'Chapter 11.6 - Bayesian analysis'
-            },
-        ],
-        'source/ch-categorical-relationships.ptx': [
-            {
-                'search': 'chi-square test',
-                'code': '''# Chi-square test of independence
-contingency_table <- table(data$var1, data$var2)
-chisq.test(contingency_table)
-
-# With Yates' continuity correction
-chisq.test(contingency_table, correct = TRUE)
-
-# Expected frequencies
-chisq_result <- chisq.test(contingency_table)
-chisq_result$expected''',
-                'indent': 2,
-                'description': 'Chapter 12.3 - Chi-square test'
-            },
-            {
-                'search': 'odds ratio',
-                'code': '''# Calculate odds ratio for 2x2 table
-library(epitools)
-oddsratio(contingency_table)
-
-# Manual odds ratio calculation
-odds1 <- contingency_table[1,1] / contingency_table[1,2]
-odds2 <- contingency_table[2,1] / contingency_table[2,2]
-or <- odds1 / odds2
-log_or <- log(or)
-cat(sprintf("Odds Ratio: %.2f\\n", or))
-cat(sprintf("Log Odds Ratio: %.2f\\n", log_or))''',
-                'indent': 2,
-                'description': 'Chapter 12.6 - Odds ratio'
-            },
-            {
-                'search': 'Cramér',
-                'code': '''# Cramér's V effect size for chi-square
-library(lsr)
-cramersV(contingency_table)
-
-# Manual calculation
-chisq_stat <- chisq.test(contingency_table)$statistic
-n <- sum(contingency_table)
-min_dim <- min(nrow(contingency_table), ncol(contingency_table))
-cramers_v <- sqrt(chisq_stat / (n * (min_dim - 1)))
-print(cramers_v)''',
-                'indent': 2,
-                'description': 'Chapter 12.7 - Cramér V'
-            },
-        ],
-        'source/ch-continuous-relationships.ptx': [
-            {
-                'search': 'Pearson correlation',
-                'code': '''# Pearson correlation coefficient
-cor.test(data$x, data$y, method = "pearson")
-
-# Correlation matrix for multiple variables
-cor(data[, c("var1", "var2", "var3")], use = "complete.obs")
-
-# Spearman's rank correlation (non-parametric)
-cor.test(data$x, data$y, method = "spearman")''',
-                'indent': 2,
-                'description': 'Chapter 13.3.1 - Correlation'
-            },
-            {
-                'search': 'linear regression',
-                'code': '''# Simple linear regression
-model <- lm(y ~ x, data = data)
-summary(model)
-
-# Extract coefficients
-coef(model)
-
-# Confidence intervals for coefficients
-confint(model)
-
-# Predictions
-new_data <- data.frame(x = c(1, 2, 3))
-predict(model, new_data, interval = "confidence")
-
-# Add regression line to plot
-plot(data$x, data$y)
-abline(model, col = "red", lwd = 2)''',
-                'indent': 2,
-                'description': 'Chapter 13.3.2 - Regression'
-            },
-            {
-                'search': 'residual',
-                'code': '''# Model diagnostics and residual analysis
-model <- lm(y ~ x, data = data)
-
-# Residual plots
-par(mfrow = c(2, 2))
-plot(model)
-
-# Test for normality of residuals
-shapiro.test(residuals(model))
-
-# Test for homoscedasticity
-library(lmtest)
-bptest(model)
-
-# Influential observations
-plot(cooks.distance(model))
-abline(h = 4/length(data$y), col = "red", lty = 2)''',
-                'indent': 2,
-                'description': 'Chapter 13.7.2 - Diagnostics'
-            },
-        ],
-        'source/ch-general-linear-model.ptx': [
-            {
-                'search': 'General Linear Model',
-                'code': '''# Multiple regression example
-model <- lm(y ~ x1 + x2 + x3, data = data)
-summary(model)
-
-# Partial R-squared
-library(rsq)
-rsq.partial(model)
-
-# ANOVA table
-anova(model)''',
-                'indent': 2,
-                'description': 'Chapter 14 intro - GLM'
-            },
-        ],
-        'source/ch-comparing-means.ptx': [
-            {
-                'search': 'One-way ANOVA',
-                'code': '''# One-way ANOVA
-model_aov <- aov(y ~ group, data = data)
-summary(model_aov)
-
-# Post-hoc tests
-TukeyHSD(model_aov)
-
-# Pairwise comparisons
-pairwise.t.test(data$y, data$group, p.adjust.method = "bonferroni")
-
-# Effect size (eta-squared)
-library(effectsize)
-eta_squared(model_aov)''',
-                'indent': 2,
-                'description': 'Chapter 15.8 - ANOVA'
-            },
-        ],
-        'source/ch-multivariate-statistics.ptx': [
-            {
-                'search': 'principal component',
-                'code': '''# Principal Component Analysis
-# Prepare data (numeric variables only)
-data_numeric <- data[, sapply(data, is.numeric)]
-
-# Standardize and perform PCA
-pca_result <- prcomp(data_numeric, scale. = TRUE)
-
-# Summary of variance explained
-summary(pca_result)
-
-# Scree plot
-plot(pca_result, type = "l", main = "Scree Plot")
-
-# Biplot
-biplot(pca_result)
-
-# Loadings
-pca_result$rotation[, 1:2]''',
-                'indent': 2,
-                'description': 'Chapter 16.3 - PCA'
-            },
-            {
-                'search': 'factor analysis',
-                'code': '''# Factor Analysis
-library(psych)
-
-# Determine number of factors
-fa.parallel(data_numeric, fa = "fa")
-
-# Perform factor analysis
-fa_result <- fa(data_numeric, nfactors = 2, rotate = "varimax")
-print(fa_result)
-
-# Factor loadings
-fa_result$loadings
-
-# Factor scores
-factor_scores <- factor.scores(data_numeric, fa_result)
-head(factor_scores$scores)''',
-                'indent': 2,
-                'description': 'Chapter 16.4 - Factor Analysis'
-            },
-        ],
-        'source/ch-practical-examples.ptx': [
-            {
-                'search': 'practical example',
-                'code': '''# Complete data analysis workflow
-# 1. Load and explore
-library(tidyverse)
-summary(data)
-str(data)
-
-# 2. Clean data
-data_clean <- data %>%
-  filter(!is.na(outcome)) %>%
-  mutate(group = factor(group))
-
-# 3. Exploratory visualization
-ggplot(data_clean, aes(x = predictor, y = outcome, color = group)) +
-  geom_point() +
-  geom_smooth(method = "lm") +
-  theme_minimal()
-
-# 4. Statistical analysis
-model <- lm(outcome ~ predictor * group, data = data_clean)
-summary(model)
-
-# 5. Check assumptions
-par(mfrow = c(2, 2))
-plot(model)''',
-                'indent': 2,
-                'description': 'Chapter 17 - Practical workflow'
-            },
-        ],
-    }
-    
-    added_count = 0
-    
-    for ptx_file_name, code_list in examples.items():
-        ptx_file = base_dir / ptx_file_name
-        
-        if not ptx_file.exists():
-            continue
-        
-        print(f"\nAdding example code to {ptx_file.name}")
-        
-        code_blocks = [(item['search'], item['code'], item['indent']) for item in code_list]
-        
-        if insert_code_blocks_in_chapter(ptx_file, code_blocks):
-            added_count += 1
+def add_example_code_to_remaining_chapters(base_dir: Path = BASE_DIR, jobs: int = 1,
+                                           rules_file: Path = RULES_FILE) -> int:
+    """
+    Add the example R code of the rule file to the PreTeXt files.
     
-    return added_count
+    Returns:
+        Number of chapters updated
+    """
+    tasks = [(base_dir, chapter['ptx'], chapter['examples'], {})
+             for chapter in load_rules(rules_file) if chapter['examples']]
+    return sum(result['updated'] for result in run_chapter_tasks(add_example_code_task, tasks, jobs))
+
 
+MANIFEST_NAME = '.r_code_manifest.json'
+CHUNK_TABLE_NAME = '.r_chunk_table.npz'
 
-def main():
+
+def file_digest(path: Path) -> Optional[str]:
+    """SHA-256 of a file's bytes, or None if it does not exist."""
+    if not path.exists():
+        return None
+    digest = hashlib.sha256()
+    with pipeline_profile.stage('hash') as counters, open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+            counters['bytes_read'] += len(block)
+    return digest.hexdigest()
+
+
+def rules_digest(rules_file: Path = RULES_FILE) -> str:
+    """
+    Fingerprint of the insertion rule set: the rule file and this script,
+    which interprets it.
+    """
+    return hashlib.sha256(f"{file_digest(rules_file)}:{file_digest(Path(__file__).resolve())}"
+                          .encode('ascii')).hexdigest()
+
+
+def chapter_inputs(chapters: List[Dict]) -> Dict[str, List[str]]:
+    """Map each target PreTeXt file to the Rmd files that feed it."""
+    return {chapter['ptx']: [chapter['rmd']] if chapter['rmd'] else [] for chapter in chapters}
+
+
+def chapter_state(base_dir: Path, ptx_name: str, rmd_names: List[str], rules: str) -> Dict:
+    """Content hashes that decide whether a chapter needs to be reconverted."""
+    return {
+        'ptx': file_digest(base_dir / ptx_name),
+        'rmd': {rmd_name: file_digest(base_dir / rmd_name) for rmd_name in rmd_names},
+        'rules': rules,
+    }
+
+
+def load_manifest(manifest_file: Path) -> Dict[str, Dict]:
+    """Read the manifest of the last run; a missing or unreadable file means 'convert everything'."""
+    try:
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifest.get('chapters', {}) if isinstance(manifest, dict) else {}
+
+
+def save_manifest(manifest_file: Path, chapters: Dict[str, Dict]):
+    """Write the manifest via a temporary file so an interrupted run leaves the old one intact."""
+    write_atomic(manifest_file, json.dumps({'version': 1, 'chapters': chapters}, indent=2, sort_keys=True) + '\n')
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse command line options."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--base-dir', type=Path, default=BASE_DIR,
+                        help='repository root containing the Rmd and source/ files')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of chapters to convert in parallel (0 = one per CPU core)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip chapters whose inputs are unchanged since the last run')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print a unified diff of the changes instead of writing any file')
+    parser.add_argument('--profile', type=Path, default=None, metavar='JSON',
+                        help='write per-stage and per-chapter timings and counters to this JSON file')
+    parser.add_argument('--cprofile', type=Path, default=None, metavar='DIR',
+                        help='write a cProfile dump per chapter task to this directory')
+    parser.add_argument('--rules', type=Path, default=RULES_FILE,
+                        help='insertion rule file (default: r_code_rules.json next to this script)')
+    parser.add_argument('--manifest', type=Path, default=None,
+                        help=f'manifest file for --incremental (default: <base-dir>/{MANIFEST_NAME})')
+    parser.add_argument('--chunk-table', type=Path, default=None, metavar='NPZ',
+                        help=f'saved chunk table of the Rmd files (default: <base-dir>/{CHUNK_TABLE_NAME})')
+    parser.add_argument('--watch', action='store_true',
+                        help='after the run, keep watching the chapter files and reconvert each chapter that changes')
+    parser.add_argument('--interval', type=float, default=0.25, metavar='SECONDS',
+                        help='how often --watch checks the files for changes (default: 0.25)')
+    args = parser.parse_args(argv)
+    if args.manifest is None:
+        args.manifest = args.base_dir / MANIFEST_NAME
+    if args.chunk_table is None:
+        args.chunk_table = args.base_dir / CHUNK_TABLE_NAME
+    if args.jobs == 0:
+        args.jobs = os.cpu_count() or 1
+    return args
+
+
+def main(argv: Optional[List[str]] = None):
     """Main function to process all chapters."""
     
-    base_dir = Path('/home/runner/work/statsthinking21-core/statsthinking21-core')
+    args = parse_args(argv)
+    base_dir = args.base_dir
+    settings = {'dry_run': args.dry_run, 'profile': args.profile is not None, 'cprofile_dir': args.cprofile}
+    if args.cprofile:
+        args.cprofile.mkdir(parents=True, exist_ok=True)
+    driver = pipeline_profile.Profiler('(driver)') if args.profile else None
+    # --watch keeps parsed chapters for the reconversions. With --jobs > 1 the
+    # first run parses in pool workers, so the cache starts cold and fills
+    # as chapters are reconverted
+    cache = WarmCache() if args.watch else None
+    with pipeline_profile.activate(driver), warm_cache(cache):
+        success_count = run_conversion(args, settings, driver)
+    if args.watch:
+        with warm_cache(cache):
+            watch_chapters(args, {'dry_run': args.dry_run, 'chunk_table': settings.get('chunk_table')})
+    return success_count
+
+
+def run_conversion(args: argparse.Namespace, settings: Dict,
+                   driver: Optional[pipeline_profile.Profiler] = None) -> int:
+    """Convert all chapters as configured by the command line; see main()."""
+    base_dir = args.base_dir
+    start_time = time.perf_counter()
     
     print("=" * 80)
     print("R Code Insertion Script for PreTeXt Files")
     print("=" * 80)
     print("\nThis script extracts displayable R code from Rmd files")
-    print("(excluding echo=FALSE chunks) and inserts them into PreTeXt files.")
+    print("(excluding echo=FALSE and include=FALSE chunks) and inserts them into PreTeXt files.")
     print("=" * 80)
     
-    success_count = 0
-    
-    # Process chapters with specific handlers
-    processors = [
-        ('14-GeneralLinearModel.Rmd', 'source/ch-general-linear-model.ptx', process_chapter_14),
-        ('15-ComparingMeans.Rmd', 'source/ch-comparing-means.ptx', process_chapter_15),
-        ('16-MultivariateStats.Rmd', 'source/ch-multivariate-statistics.ptx', process_chapter_16),
-    ]
-    
-    for rmd_name, ptx_name, processor_func in processors:
-        rmd_file = base_dir / rmd_name
-        ptx_file = base_dir / ptx_name
-        
-        if not rmd_file.exists():
-            print(f"⚠ Warning: {rmd_file} not found")
-            continue
-        
-        if not ptx_file.exists():
-            print(f"⚠ Warning: {ptx_file} not found")
-            continue
-        
-        try:
-            if processor_func(rmd_file, ptx_file):
-                success_count += 1
-        except Exception as e:
-            print(f"✗ Error processing {rmd_name}: {e}")
-            import traceback
-            traceback.print_exc()
+    # With --incremental, leave out chapters whose inputs match the last run
+    chapters = load_rules(args.rules)
+    inputs = chapter_inputs(chapters)
+    rules = rules_digest(args.rules)
+    manifest = load_manifest(args.manifest) if args.incremental else {}
+    unchanged = set()
+    for ptx_name, rmd_names in inputs.items():
+        if ptx_name in manifest and manifest[ptx_name] == chapter_state(base_dir, ptx_name, rmd_names, rules):
+            unchanged.add(ptx_name)
+    if unchanged:
+        print(f"\n⊘ {len(unchanged)} chapters unchanged since the last run:")
+        for ptx_name in inputs:
+            if ptx_name in unchanged:
+                print(f"  ⊘ {ptx_name}")
+    
+    # Place the Rmd chunks of chapters that have an Rmd file. The chunks come
+    # from the saved chunk table, in which only changed Rmd files are re-tokenized
+    rmd_files = [base_dir / chapter['rmd'] for chapter in chapters
+                 if chapter['rmd'] and chapter['ptx'] not in unchanged and (base_dir / chapter['rmd']).exists()]
+    with pipeline_profile.stage('chunk_table'):
+        settings['chunk_table'] = ChunkTable.cached(args.chunk_table, rmd_files, save=not args.dry_run)
+    tasks = [(base_dir, chapter, settings) for chapter in chapters
+             if chapter['rmd'] and chapter['ptx'] not in unchanged]
+    results = run_chapter_tasks(process_chapter_task, tasks, args.jobs)
     
     # Add example code to other chapters
     print("\n" + "=" * 80)
     print("Adding example code to chapters without displayable Rmd chunks...")
     print("=" * 80)
     
-    example_count = add_example_code_to_remaining_chapters()
-    success_count += example_count
+    tasks = [(base_dir, chapter['ptx'], chapter['examples'], settings) for chapter in chapters
+             if chapter['examples'] and chapter['ptx'] not in unchanged]
+    results += run_chapter_tasks(add_example_code_task, tasks, args.jobs)
+    
+    success_count = sum(result['updated'] for result in results)
+    
+    if args.incremental and not args.dry_run:
+        # Record the post-run state of every chapter that converted cleanly
+        failed = set(result['chapter'] for result in results if result['error'])
+        for ptx_name, rmd_names in inputs.items():
+            if ptx_name in failed:
+                manifest.pop(ptx_name, None)
+            elif ptx_name not in unchanged:
+                manifest[ptx_name] = chapter_state(base_dir, ptx_name, rmd_names, rules)
+        save_manifest(args.manifest, manifest)
     
     print("\n" + "=" * 80)
     print(f"Processing complete: {success_count} chapters updated with R code")
+    print(f"Code blocks: {sum(len(r['inserted']) for r in results)} inserted, "
+          f"{sum(len(r['skipped']) for r in results)} skipped, "
+          f"{sum(len(r['missed']) for r in results)} missed")
     print("=" * 80)
     
-    return success_count
+    if args.profile:
+        snapshots = [driver.snapshot()] + [result['profile'] for result in results if 'profile' in result]
+        report = pipeline_profile.build_report(snapshots, time.perf_counter() - start_time,
+                                               jobs=args.jobs, incremental=args.incremental,
+                                               dry_run=args.dry_run, unchanged=sorted(unchanged))
+        pipeline_profile.write_report(args.profile, report)
+        print(f"Profile written to {args.profile}")
+    
+    # Chapters skipped as unchanged are up to date, which counts as success
+    return success_count + len(unchanged)
+
+
+
+def chapter_files(base_dir: Path, chapter: Dict) -> List[Path]:
+    """The input files of a chapter: its Rmd file (if any) and its PreTeXt file."""
+    return ([base_dir / chapter['rmd']] if chapter['rmd'] else []) + [base_dir / chapter['ptx']]
+
+
+def reconvert_chapter(base_dir: Path, chapter: Dict, settings: Dict) -> List[Dict]:
+    """Run both passes (Rmd chunks, then example code) for a single chapter."""
+    results = []
+    if chapter['rmd']:
+        results.append(process_chapter_task((base_dir, chapter, settings)))
+    if chapter['examples']:
+        results.append(add_example_code_task((base_dir, chapter['ptx'], chapter['examples'], settings)))
+    return results
+
+
+def watch_chapters(args: argparse.Namespace, settings: Dict):
+    """
+    Poll the chapter files and the rule file, and reconvert only the chapters
+    whose files changed, until interrupted with Ctrl-C.
+    
+    Changes are detected from stat() signatures, so no watcher service is
+    needed. Unchanged Rmd files and PreTeXt anchor indexes are reused from the
+    active WarmCache (see main).
+    """
+    base_dir = args.base_dir
+    chapters = load_rules(args.rules)
+    rules_signature = stat_signature(args.rules)
+    signatures = {path: stat_signature(path) for chapter in chapters for path in chapter_files(base_dir, chapter)}
+    manifest = load_manifest(args.manifest) if args.incremental and not args.dry_run else None
+    
+    print(f"\n👀 Watching {len(signatures)} chapter files and {args.rules.name} (Ctrl-C to stop)")
+    try:
+        while True:
+            time.sleep(args.interval)
+            
+            changed = []
+            signature = stat_signature(args.rules)
+            if signature != rules_signature:
+                rules_signature = signature
+                try:
+                    chapters = load_rules(args.rules)
+                except (OSError, ValueError) as e:
+                    print(f"✗ Keeping the previous rules, {args.rules} is invalid: {e}")
+                else:
+                    print(f"\n↻ {args.rules.name} changed")
+                    changed = list(chapters)
+            
+            for chapter in chapters:
+                files = chapter_files(base_dir, chapter)
+                current = [stat_signature(path) for path in files]
+                if any(signatures.get(path) != sig for path, sig in zip(files, current)):
+                    if chapter not in changed:
+                        changed.append(chapter)
+                    # Rmd signatures are taken before the conversion reads the file,
+                    # so a save during the conversion is picked up next time
+                    signatures.update(zip(files, current))
+            
+            for chapter in changed:
+                start = time.perf_counter()
+                print(f"\n↻ {chapter['ptx']} changed")
+                results = reconvert_chapter(base_dir, chapter, settings)
+                # Our own write must not count as a change
+                ptx_file = base_dir / chapter['ptx']
+                signatures[ptx_file] = stat_signature(ptx_file)
+                if manifest is not None and not any(result['error'] for result in results):
+                    rmd_names = [chapter['rmd']] if chapter['rmd'] else []
+                    manifest[chapter['ptx']] = chapter_state(base_dir, chapter['ptx'], rmd_names,
+                                                             rules_digest(args.rules))
+                    save_manifest(args.manifest, manifest)
+                print(f"✓ {chapter['ptx']}: {sum(len(r['inserted']) for r in results)} inserted, "
+                      f"{sum(len(r['skipped']) for r in results)} skipped, "
+                      f"{sum(len(r['missed']) for r in results)} missed "
+                      f"in {time.perf_counter() - start:.3f} s")
+    except KeyboardInterrupt:
+        print("\nStopped watching")
 
 
 if __name__ == '__main__':
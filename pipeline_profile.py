@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Lightweight stage timing and counters for the Rmd -> PreTeXt scripts.
+
+Code marks its stages with the `stage` context manager or the `timed`
+decorator:
+
+    with pipeline_profile.stage('read') as counters:
+        content = ptx_file.read_text()
+        counters['bytes_read'] += len(content)
+
+Nothing is recorded unless a Profiler is active (see `activate`), so the
+instrumentation costs one global lookup per stage in normal runs. Each chapter
+gets its own Profiler, whose snapshot is a plain dict, so results from worker
+processes can be sent back and merged into one JSON report.
+"""
+
+import functools
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+
+COUNTERS = ('bytes_read', 'bytes_written', 'chunks', 'insertions')
+
+_active: Optional['Profiler'] = None
+
+
+def _new_stage() -> Dict:
+    record = {'calls': 0, 'seconds': 0.0}
+    record.update((name, 0) for name in COUNTERS)
+    return record
+
+
+class Profiler:
+    """Per-stage wall time, call counts and counters for one chapter (or the driver)."""
+
+    def __init__(self, chapter: str = ''):
+        self.chapter = chapter
+        self.stages: Dict[str, Dict] = defaultdict(_new_stage)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Dict]:
+        record = self.stages[name]
+        record['calls'] += 1
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] += time.perf_counter() - start
+
+    def snapshot(self) -> Dict:
+        """Recorded values as plain, picklable and JSON-serializable data."""
+        return {'chapter': self.chapter, 'stages': {name: dict(record) for name, record in self.stages.items()}}
+
+
+@contextmanager
+def activate(profiler: Optional[Profiler]) -> Iterator[Optional[Profiler]]:
+    """Make a profiler the target of `stage` calls for the duration of the block."""
+    global _active
+    previous = _active
+    _active = profiler
+    try:
+        yield profiler
+    finally:
+        _active = previous
+
+
+@contextmanager
+def stage(name: str) -> Iterator[Dict]:
+    """
+    Time a stage on the active profiler and yield its counter dict.
+    Without an active profiler the counters go to a throwaway dict.
+    """
+    if _active is None:
+        yield defaultdict(int)
+        return
+    with _active.stage(name) as record:
+        yield record
+
+
+def timed(name: str) -> Callable:
+    """Decorator form of `stage` for functions that are a stage on their own."""
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def build_report(snapshots: List[Dict], wall_seconds: float, **settings) -> Dict:
+    """
+    Merge profiler snapshots into a report with per-chapter and per-stage
+    totals. Snapshots for the same chapter (e.g. from two passes) are summed.
+    """
+    chapters: Dict[str, Dict[str, Dict]] = defaultdict(lambda: defaultdict(_new_stage))
+    totals: Dict[str, Dict] = defaultdict(_new_stage)
+    for snapshot in snapshots:
+        for name, record in snapshot['stages'].items():
+            for target in (chapters[snapshot['chapter']][name], totals[name]):
+                for key, value in record.items():
+                    target[key] += value
+
+    return {
+        'version': 1,
+        'wall_seconds': wall_seconds,
+        'settings': settings,
+        'stages': {name: totals[name] for name in sorted(totals)},
+        'chapters': {chapter: {name: stages[name] for name in sorted(stages)}
+                     for chapter, stages in sorted(chapters.items())},
+    }
+
+
+def write_report(path: Path, report: Dict):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
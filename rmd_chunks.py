@@ -0,0 +1,563 @@
+#!/usr/bin/env python3
+"""
+Shared tokenizer for R code chunks in Rmd files.
+
+Both insert_r_code.py and add_r_code_to_pretext.py need the R chunks of a
+chapter together with their line numbers. This module walks the file once,
+line by line, so extraction is linear in the size of the document and never
+slices or re-scans the whole text.
+
+Chunks are returned as compact ChunkRecord objects that only hold byte
+offsets into a shared, read-only buffer of the Rmd file (an mmap by default).
+The code, header and surrounding context are decoded on access, so chunk
+tables for many chapters or books take little memory.
+
+Chunk headers are parsed with parse_chunk_options, which understands knitr's
+option syntax (label, quoted strings, TRUE/FALSE/T/F, numbers, R
+expressions). ChunkTable collects the parsed chunks of many files in typed
+numpy columns that can be filtered, saved as .npz and reused by the
+conversion scripts, which select their chunks from it (see
+displayable_chunks) instead of tokenizing every Rmd file on each run.
+
+A chunk starts at ```{r ...} and ends at the next ``` (the same rules the
+original regex ```\\{r\\s*([^}]*)\\}(.*?)``` used); headers must fit on one line.
+"""
+
+import argparse
+import json
+import mmap
+import os
+import re
+import tempfile
+import zipfile
+from bisect import bisect_right
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+
+CHUNK_OPEN = re.compile(rb'```\{r\s*([^}\n]*)\}')
+FENCE = b'```'
+
+# knitr's defaults for the options the conversion scripts care about
+DEFAULT_OPTIONS = {'echo': True, 'eval': True, 'include': True, 'cache': False}
+R_CONSTANTS = {'TRUE': True, 'T': True, 'FALSE': False, 'F': False, 'NULL': None, 'NA': None}
+NUMBER = re.compile(r'[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+
+
+def _is_continuation(byte: int) -> bool:
+    """True for the trailing bytes of a multi-byte UTF-8 character."""
+    return (byte & 0xC0) == 0x80
+
+
+class RmdSource:
+    """
+    Read-only buffer over one Rmd file, shared by all of its chunk records.
+
+    Args:
+        path: Path to the Rmd file
+        context_before: Number of characters of context chunk records expose before the chunk
+        context_after: Number of characters of context chunk records expose after the chunk
+        use_mmap: Map the file instead of reading it. Pass False if the file may be
+            truncated in place while records are alive (e.g. in a long-running process)
+    """
+
+    __slots__ = ('path', 'buffer', 'context_before', 'context_after')
+
+    def __init__(self, path: Path, context_before: int = 0, context_after: int = 0,
+                 use_mmap: bool = True):
+        self.path = Path(path)
+        self.context_before = context_before
+        self.context_after = context_after
+        with open(self.path, 'rb') as f:
+            if use_mmap and self.path.stat().st_size > 0:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.buffer = f.read()
+
+    def __len__(self) -> int:
+        return len(self.buffer)
+
+    def text(self, start: int, end: int) -> str:
+        """Decode the bytes [start, end) with newlines normalized like text-mode reads."""
+        return self.buffer[start:end].decode('utf-8').replace('\r\n', '\n')
+
+    def text_before(self, offset: int, chars: int) -> str:
+        """The last `chars` characters before a byte offset."""
+        if chars <= 0:
+            return ''
+        start = max(0, offset - 4 * chars)
+        while 0 < start < offset and _is_continuation(self.buffer[start]):
+            start += 1
+        return self.text(start, offset)[-chars:]
+
+    def text_after(self, offset: int, chars: int) -> str:
+        """The first `chars` characters after a byte offset."""
+        if chars <= 0:
+            return ''
+        end = min(len(self.buffer), offset + 4 * chars + 3)
+        while offset < end < len(self.buffer) and _is_continuation(self.buffer[end]):
+            end -= 1
+        return self.text(offset, end)[:chars]
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+
+def _split_top_level(text: str, separator: str) -> List[str]:
+    """Split on a separator that is not inside quotes or brackets."""
+    parts = []
+    depth = 0
+    quote = None
+    current = []
+    for i, char in enumerate(text):
+        if quote:
+            if char == quote and text[i - 1] != '\\':
+                quote = None
+        elif char in '"\'`':
+            quote = char
+        elif char in '([{':
+            depth += 1
+        elif char in ')]}':
+            depth -= 1
+        elif char == separator and depth == 0:
+            parts.append(''.join(current))
+            current = []
+            continue
+        current.append(char)
+    parts.append(''.join(current))
+    return parts
+
+
+def parse_option_value(value: str) -> Any:
+    """
+    Convert an R literal to Python: TRUE/FALSE/T/F to bool, NULL/NA to None,
+    numbers to int/float and quoted strings to str. Anything else (c(...),
+    variable names, calls) is kept as the R expression text.
+    """
+    value = value.strip()
+    if value in R_CONSTANTS:
+        return R_CONSTANTS[value]
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    if NUMBER.match(value):
+        number = float(value)
+        return int(number) if number.is_integer() and re.match(r'[-+]?\d+$', value) else number
+    return value
+
+
+def parse_chunk_options(header: str) -> Dict[str, Any]:
+    """
+    Parse a knitr chunk header (the text after ``{r``) into an options dict.
+
+    The first unnamed item is the chunk label and is stored under 'label'
+    (as knitr does); it is None for unlabelled chunks. Defaults from
+    DEFAULT_OPTIONS are filled in for options the header does not set.
+    """
+    options: Dict[str, Any] = {'label': None}
+    options.update(DEFAULT_OPTIONS)
+    positional = 0
+    for item in _split_top_level(header, ','):
+        item = item.strip()
+        if not item:
+            continue
+        key_value = _split_top_level(item, '=')
+        if len(key_value) > 1 and key_value[0].strip():
+            options[key_value[0].strip()] = parse_option_value('='.join(key_value[1:]))
+        else:
+            if positional == 0:
+                options['label'] = str(parse_option_value(item))
+            positional += 1
+    return options
+
+
+def is_displayable(options: Dict[str, Any]) -> bool:
+    """True if knitr shows the chunk's code in the rendered book."""
+    return options.get('echo') is not False and options.get('include') is not False
+
+
+def is_figure(options: Dict[str, Any]) -> bool:
+    """True if the chunk sets any figure (fig.*) or output size (out.*) option."""
+    return any(key.startswith(('fig.', 'out.')) for key in options)
+
+
+class ChunkRecord:
+    """
+    One R chunk as byte offsets into its RmdSource.
+
+    `header`, `code`, `context_before` and `context_after` are decoded on
+    access. Item access (chunk['code']) is supported for callers written
+    against the older dict-based chunks. `name` is left for callers to fill in.
+    """
+
+    __slots__ = ('source', 'line_num', 'start', 'header_start', 'header_end', 'end', 'name', '_options')
+
+    def __init__(self, source: RmdSource, line_num: int, start: int, header_start: int,
+                 header_end: int, end: int, name: Optional[str] = None):
+        self.source = source
+        self.line_num = line_num
+        self.start = start
+        self.header_start = header_start
+        self.header_end = header_end
+        self.end = end
+        self.name = name
+        self._options = None
+
+    @property
+    def header(self) -> str:
+        """Text between ``{r`` and ``}``, stripped."""
+        return self.source.text(self.header_start, self.header_end).strip()
+
+    @property
+    def options(self) -> Dict[str, Any]:
+        """Parsed chunk options (see parse_chunk_options); parsed once, on first access."""
+        if self._options is None:
+            self._options = parse_chunk_options(self.header)
+        return self._options
+
+    @property
+    def code(self) -> str:
+        """Chunk body, stripped."""
+        return self.source.text(self.header_end + 1, self.end - len(FENCE)).strip()
+
+    @property
+    def context_before(self) -> str:
+        return self.source.text_before(self.start, self.source.context_before)
+
+    @property
+    def context_after(self) -> str:
+        return self.source.text_after(self.end, self.source.context_after)
+
+    def __getitem__(self, key: str):
+        return getattr(self, key)
+
+    def __repr__(self) -> str:
+        return f"ChunkRecord({self.source.path.name}:{self.line_num}, name={self.name!r})"
+
+
+class LineIndex:
+    """
+    Offset of the start of every line, filled in while streaming.
+
+    Line number -> offset is a list lookup and offset -> line number is a
+    binary search, so positions never need to be recomputed by counting
+    newlines in a prefix of the document.
+    """
+
+    def __init__(self):
+        self.starts = [0]
+
+    def append(self, line_length: int):
+        self.starts.append(self.starts[-1] + line_length)
+
+    def offset_of(self, line_num: int) -> int:
+        """Offset of the first character of a 1-based line number."""
+        return self.starts[line_num - 1]
+
+    def line_of(self, offset: int) -> int:
+        """1-based line number containing an offset."""
+        return bisect_right(self.starts, offset)
+
+
+def iter_r_chunks(source: RmdSource) -> Iterator[ChunkRecord]:
+    """
+    Tokenize R code chunks from an Rmd source, one line at a time.
+
+    Args:
+        source: RmdSource holding the file's bytes
+
+    Yields:
+        ChunkRecord objects in document order. Empty chunks are included.
+    """
+    buffer = source.buffer
+    size = len(buffer)
+    offset = 0
+    line_num = 0
+    open_chunk = None  # (line_num, start, header_start, header_end) while inside a chunk
+
+    while offset < size:
+        newline = buffer.find(b'\n', offset)
+        line_end = size if newline == -1 else newline + 1
+        line = buffer[offset:line_end]
+        line_num += 1
+
+        pos = 0
+        while True:
+            if open_chunk is None:
+                match = CHUNK_OPEN.search(line, pos)
+                if match is None:
+                    break
+                open_chunk = (line_num, offset + match.start(),
+                              offset + match.start(1), offset + match.end(1))
+                pos = match.end()
+            else:
+                close = line.find(FENCE, pos)
+                if close == -1:
+                    break
+                yield ChunkRecord(source, *open_chunk, offset + close + len(FENCE))
+                open_chunk = None
+                pos = close + len(FENCE)
+
+        offset = line_end
+
+
+def read_r_chunks(rmd_file: Path, context_before: int = 0, context_after: int = 0,
+                  use_mmap: bool = True) -> List[ChunkRecord]:
+    """Read all R code chunks from an Rmd file in a single streaming pass (see RmdSource for use_mmap)."""
+    return list(iter_r_chunks(RmdSource(rmd_file, context_before, context_after, use_mmap)))
+
+
+class ChunkTable:
+    """
+    Column-oriented table of the R chunks of one or more Rmd files.
+
+    Columns are numpy arrays with one entry per chunk: the chunk's byte
+    offsets and line number, its label, and booleans for the knitr options
+    that decide what the scripts do with it. `file` indexes `files`, the
+    resolved paths of the Rmd files. Selections such as "the displayable
+    chunks of a file" are vectorized comparisons (see where), and `options`
+    keeps the full parsed options of each chunk.
+
+    The stat signature of each file is recorded, so update() re-tokenizes
+    only files that changed, and a table saved with save() spares later runs
+    the parsing of unchanged files.
+    """
+
+    COLUMNS = {
+        'file': np.int32, 'line_num': np.int64, 'start': np.int64, 'header_start': np.int64,
+        'header_end': np.int64, 'end': np.int64, 'code_lines': np.int64, 'label': np.str_,
+        'echo': np.bool_, 'eval': np.bool_, 'include': np.bool_, 'cache': np.bool_,
+        'figure': np.bool_, 'displayable': np.bool_,
+    }
+
+    def __init__(self):
+        self.columns = {name: np.zeros(0, dtype=dtype) for name, dtype in self.COLUMNS.items()}
+        self.options: List[Dict[str, Any]] = []
+        self.files: List[str] = []
+        self.signatures: List[Tuple[int, int]] = []
+
+    def __len__(self) -> int:
+        return len(self.columns['file'])
+
+    def __getitem__(self, name: str):
+        return self.options if name == 'options' else self.columns[name]
+
+    def file_id(self, rmd_file: Path) -> int:
+        """Index of a file in `files`, or -1 if the table has no rows for it."""
+        key = str(Path(rmd_file).resolve())
+        return self.files.index(key) if key in self.files else -1
+
+    def is_current(self, rmd_file: Path) -> bool:
+        """True if the table holds the chunks of the file as it is now on disk."""
+        file_id = self.file_id(rmd_file)
+        return file_id >= 0 and self.signatures[file_id] == file_signature(rmd_file)
+
+    def update(self, rmd_files: Iterable[Path]) -> bool:
+        """
+        Tokenize the files that are new or changed since they were added,
+        parsing each chunk header once, and replace their rows.
+
+        Returns:
+            True if any rows changed
+        """
+        changed = False
+        for rmd_file in rmd_files:
+            if self.is_current(rmd_file):
+                continue
+            file_id = self.file_id(rmd_file)
+            signature = file_signature(rmd_file)
+            if file_id < 0:
+                file_id = len(self.files)
+                self.files.append(str(Path(rmd_file).resolve()))
+                self.signatures.append(signature)
+            else:
+                self.signatures[file_id] = signature
+                self._keep(self.columns['file'] != file_id)
+            self._append(file_id, iter_r_chunks(RmdSource(rmd_file, use_mmap=False)))
+            changed = True
+        return changed
+
+    def _append(self, file_id: int, chunks: Iterable[ChunkRecord]):
+        rows: Dict[str, list] = {name: [] for name in self.COLUMNS}
+        for chunk in chunks:
+            options = chunk.options
+            code = chunk.code
+            rows['file'].append(file_id)
+            rows['line_num'].append(chunk.line_num)
+            rows['start'].append(chunk.start)
+            rows['header_start'].append(chunk.header_start)
+            rows['header_end'].append(chunk.header_end)
+            rows['end'].append(chunk.end)
+            rows['code_lines'].append(code.count('\n') + 1 if code else 0)
+            rows['label'].append(options['label'] or '')
+            rows['echo'].append(options['echo'] is not False)
+            rows['eval'].append(options['eval'] is not False)
+            rows['include'].append(options['include'] is not False)
+            rows['cache'].append(bool(options['cache']))
+            rows['figure'].append(is_figure(options))
+            rows['displayable'].append(is_displayable(options) and bool(code))
+            self.options.append(options)
+        for name, dtype in self.COLUMNS.items():
+            self.columns[name] = np.concatenate([self.columns[name], np.array(rows[name], dtype=dtype)])
+
+    def _keep(self, mask: np.ndarray):
+        for name in self.COLUMNS:
+            self.columns[name] = self.columns[name][mask]
+        self.options = [options for options, keep in zip(self.options, mask) if keep]
+
+    @classmethod
+    def from_files(cls, rmd_files: Iterable[Path]) -> 'ChunkTable':
+        """Build a table from Rmd files, in the order given."""
+        table = cls()
+        table.update(rmd_files)
+        return table
+
+    def where(self, **conditions) -> np.ndarray:
+        """
+        Row indices whose columns equal all the given values, e.g.
+        where(file=rmd_file, displayable=True); files are matched by resolved path.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for name, value in conditions.items():
+            if name == 'file':
+                value = self.file_id(value)
+            mask &= self.columns[name] == value
+        return np.flatnonzero(mask)
+
+    def select(self, rows: Iterable[int]) -> 'ChunkTable':
+        """A new table holding only the given rows."""
+        rows = np.asarray(list(rows) if not isinstance(rows, np.ndarray) else rows, dtype=np.intp)
+        table = ChunkTable()
+        table.files = list(self.files)
+        table.signatures = list(self.signatures)
+        table.columns = {name: column[rows] for name, column in self.columns.items()}
+        table.options = [self.options[i] for i in rows]
+        return table
+
+    def chunk_records(self, rows: Iterable[int], context_before: int = 0, context_after: int = 0,
+                      use_mmap: bool = True) -> List[ChunkRecord]:
+        """
+        ChunkRecords for the given rows, built from the stored offsets and
+        options without tokenizing the files again. `name` is the label, or
+        'unnamed'. The files must be current (see is_current).
+        """
+        sources: Dict[int, RmdSource] = {}
+        columns = self.columns
+        records = []
+        for i in rows:
+            file_id = int(columns['file'][i])
+            if file_id not in sources:
+                sources[file_id] = RmdSource(self.files[file_id], context_before, context_after, use_mmap)
+            record = ChunkRecord(sources[file_id], int(columns['line_num'][i]), int(columns['start'][i]),
+                                 int(columns['header_start'][i]), int(columns['header_end'][i]),
+                                 int(columns['end'][i]), str(columns['label'][i]) or 'unnamed')
+            record._options = self.options[i]
+            records.append(record)
+        return records
+
+    def records(self) -> Iterator[Dict[str, Any]]:
+        """Rows as dicts, for display."""
+        for i in range(len(self)):
+            row = {name: column[i].item() for name, column in self.columns.items()}
+            row['file'] = self.files[row['file']]
+            row['options'] = self.options[i]
+            yield row
+
+    def save(self, path: Path):
+        """Write the table to an .npz file, via a temporary file so readers never see a partial one."""
+        path = Path(path)
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, version=np.array(TABLE_VERSION), files=np.array(self.files, dtype=np.str_),
+                                    signatures=np.array(self.signatures, dtype=np.int64).reshape(-1, 2),
+                                    options=np.array([json.dumps(options) for options in self.options], dtype=np.str_),
+                                    **{f'column_{name}': column for name, column in self.columns.items()})
+            # mkstemp creates the file as 0600; give it the mode open() would
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_name, 0o666 & ~umask)
+            os.replace(tmp_name, path)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+    @classmethod
+    def load(cls, path: Path) -> 'ChunkTable':
+        table = cls()
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['version']) != TABLE_VERSION:
+                raise ValueError(f'{path} is not a version {TABLE_VERSION} chunk table')
+            table.files = [str(name) for name in data['files']]
+            table.signatures = [tuple(int(v) for v in row) for row in data['signatures']]
+            table.options = [json.loads(str(options)) for options in data['options']]
+            table.columns = {name: data[f'column_{name}'].astype(dtype) for name, dtype in cls.COLUMNS.items()}
+        return table
+
+    @classmethod
+    def cached(cls, path: Optional[Path], rmd_files: Iterable[Path], save: bool = True) -> 'ChunkTable':
+        """
+        The table saved at path (if it is readable), brought up to date for
+        rmd_files and saved again if anything changed (and save is set).
+        """
+        table = None
+        if path is not None and Path(path).exists():
+            try:
+                table = cls.load(path)
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+                print(f"⚠ Rebuilding the chunk table, {path} is unreadable: {e}")
+        if table is None:
+            table = cls()
+        if table.update(rmd_files) and save and path is not None:
+            table.save(path)
+        return table
+
+
+TABLE_VERSION = 1
+
+
+def file_signature(path: Path) -> Tuple[int, int]:
+    """(mtime in ns, size) of a file, which the chunk table uses to notice changed files."""
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def displayable_chunks(rmd_file: Path, table: Optional[ChunkTable] = None, context_before: int = 0,
+                       context_after: int = 0, use_mmap: bool = True) -> List[ChunkRecord]:
+    """
+    The non-empty chunks of an Rmd file whose code knitr shows, selected from
+    a chunk table. The table is first brought up to date for the file; with
+    no table, a temporary in-memory one is built.
+    """
+    if table is None:
+        table = ChunkTable()
+    table.update([rmd_file])
+    return table.chunk_records(table.where(file=rmd_file, displayable=True),
+                               context_before, context_after, use_mmap)
+
+
+def main():
+    """Build the chunk table for a set of Rmd files and print a summary."""
+    parser = argparse.ArgumentParser(description='Tabulate the R chunks of Rmd files.')
+    parser.add_argument('rmd_files', nargs='+', type=Path)
+    parser.add_argument('-o', '--output', type=Path, help='save the table as .npz')
+    args = parser.parse_args()
+
+    table = ChunkTable.from_files(args.rmd_files)
+    for rmd_file in args.rmd_files:
+        subset = table.select(table.where(file=rmd_file))
+        print(f"{rmd_file.name}: {len(subset)} chunks, "
+              f"{subset['displayable'].sum()} displayable, "
+              f"{subset['figure'].sum()} figure, "
+              f"{subset['cache'].sum()} cached, "
+              f"{len(subset) - subset['eval'].sum()} not evaluated")
+
+    if args.output:
+        table.save(args.output)
+        print(f"Saved {len(table)} chunks to {args.output}")
+
+
+if __name__ == '__main__':
+    main()